@@ -0,0 +1,495 @@
+import os
+import struct
+from math import ceil, gcd
+
+import numpy as np
+
+FINGERPRINT_SAMPLE_RATE = 16000
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _pcm_dtype(width, is_float, byteorder, unsigned_8bit):
+    if is_float:
+        return {4: f"{byteorder}f4", 8: f"{byteorder}f8"}.get(width)
+    if width == 1:
+        return "u1" if unsigned_8bit else "i1"
+    # 24-bit samples have no numpy dtype; they are mapped as raw bytes and widened per window
+    return {2: f"{byteorder}i2", 3: "u1", 4: f"{byteorder}i4"}.get(width)
+
+
+def _parse_wav(fh, file_size):
+    riff_id, _, wave_id = struct.unpack("<4sI4s", fh.read(12))
+    if riff_id not in (b"RIFF", b"RF64") or wave_id != b"WAVE":
+        return None
+
+    fmt = None
+    ds64_data_size = None
+
+    while True:
+        chunk_header = fh.read(8)
+        if len(chunk_header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+        chunk_start = fh.tell()
+
+        if chunk_id == b"ds64":
+            # RF64 stores the real 64-bit data size here for files over 4 GiB
+            ds64_data_size = struct.unpack("<QQQ", fh.read(24))[1]
+        elif chunk_id == b"fmt ":
+            body = fh.read(chunk_size)
+            if len(body) < 16:
+                return None
+            format_tag, channels, samplerate, _, block_align, bits = struct.unpack("<HHIIHH", body[:16])
+            if format_tag == _WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                format_tag = struct.unpack("<H", body[24:26])[0]
+            if format_tag not in (_WAVE_FORMAT_PCM, _WAVE_FORMAT_IEEE_FLOAT) or not channels:
+                return None
+            width = block_align // channels
+            dtype = _pcm_dtype(width, format_tag == _WAVE_FORMAT_IEEE_FLOAT, "<", unsigned_8bit=True)
+            if dtype is None:
+                return None
+            fmt = (channels, samplerate, width, dtype)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                chunk_size = ds64_data_size
+            data_size = min(chunk_size, file_size - chunk_start)
+            return (*fmt, chunk_start, data_size, "<")
+
+        fh.seek(chunk_start + chunk_size + (chunk_size & 1))
+
+
+def _parse_ieee_extended(data):
+    exponent, mantissa = struct.unpack(">HQ", data)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent &= 0x7FFF
+    if exponent == 0 and mantissa == 0:
+        return 0.0
+    return sign * mantissa * 2.0 ** (exponent - 16383 - 63)
+
+
+def _parse_aiff(fh, file_size):
+    form_id, _, form_type = struct.unpack(">4sI4s", fh.read(12))
+    if form_id != b"FORM" or form_type not in (b"AIFF", b"AIFC"):
+        return None
+
+    fmt = None
+    byteorder = ">"
+
+    while True:
+        chunk_header = fh.read(8)
+        if len(chunk_header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack(">4sI", chunk_header)
+        chunk_start = fh.tell()
+
+        if chunk_id == b"COMM":
+            body = fh.read(chunk_size)
+            if len(body) < 18:
+                return None
+            channels, _, bits = struct.unpack(">hIh", body[:8])
+            samplerate = _parse_ieee_extended(body[8:18])
+            compression = body[18:22] if form_type == b"AIFC" else b"NONE"
+            if compression in (b"NONE", b"twos"):
+                byteorder, is_float = ">", False
+            elif compression == b"sowt":
+                byteorder, is_float = "<", False
+            elif compression in (b"fl32", b"FL32", b"fl64", b"FL64"):
+                byteorder, is_float = ">", True
+            else:
+                return None
+            if channels <= 0 or samplerate <= 0:
+                return None
+            width = (bits + 7) // 8
+            dtype = _pcm_dtype(width, is_float, byteorder, unsigned_8bit=False)
+            if dtype is None:
+                return None
+            fmt = (channels, int(samplerate), width, dtype)
+        elif chunk_id == b"SSND":
+            if fmt is None:
+                return None
+            data_offset = struct.unpack(">I", fh.read(4))[0]
+            data_start = chunk_start + 8 + data_offset
+            data_size = min(chunk_size - 8 - data_offset, file_size - data_start)
+            return (*fmt, data_start, data_size, byteorder)
+
+        fh.seek(chunk_start + chunk_size + (chunk_size & 1))
+
+
+class _MemmapSource:
+    """Uncompressed PCM mapped straight from disk; reads return views into the mapping."""
+
+    def __init__(self, filepath, channels, samplerate, width, dtype, offset, size, byteorder):
+        self.channels = channels
+        self.samplerate = samplerate
+        self.frames = size // (width * channels)
+        self._width = width
+        self._byteorder = byteorder
+        self._offset = offset
+        self._frame_bytes = width * channels
+        shape = (self.frames, channels, 3) if width == 3 else (self.frames, channels)
+        self._map = np.memmap(filepath, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def read(self, start, count):
+        window = self._map[start:start + count]
+        if self._width != 3:
+            return window
+        low, mid, high = (0, 1, 2) if self._byteorder == "<" else (2, 1, 0)
+        widened = (
+            (window[..., low].astype(np.uint32) << 8)
+            | (window[..., mid].astype(np.uint32) << 16)
+            | (window[..., high].astype(np.uint32) << 24)
+        )
+        return widened.view(np.int32)
+
+    def byte_range(self, start, count):
+        return self._offset + start * self._frame_bytes, count * self._frame_bytes
+
+    def close(self):
+        self._map = None
+
+
+class _SoundFileSource:
+    """Any container libsndfile can decode (FLAC, MP3, ...); reads seek and decode only the requested blocks."""
+
+    def __init__(self, filepath):
+        import soundfile as sf
+
+        self._file = sf.SoundFile(filepath)
+        self.channels = self._file.channels
+        self.samplerate = self._file.samplerate
+        self.frames = self._file.frames
+        self._size = os.path.getsize(filepath)
+
+    def read(self, start, count):
+        self._file.seek(start)
+        return self._file.read(count, dtype="float32", always_2d=True)
+
+    def byte_range(self, start, count):
+        # Compressed, so only an estimate: assume a constant bitrate and widen it by a margin
+        # for codec frames and seek tables either side
+        margin = 64 * 1024
+        bytes_per_frame = self._size / max(1, self.frames)
+        offset = max(0, int(start * bytes_per_frame) - margin)
+        return offset, int(count * bytes_per_frame) + 2 * margin
+
+    def close(self):
+        self._file.close()
+
+
+class AudioSource:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._source = None
+        self._hint_fd = None
+
+        try:
+            layout = None
+            with open(filepath, "rb") as fh:
+                file_size = fh.seek(0, 2)
+                fh.seek(0)
+                magic = fh.read(12)
+                fh.seek(0)
+                if len(magic) == 12:
+                    if magic[:4] in (b"RIFF", b"RF64"):
+                        layout = _parse_wav(fh, file_size)
+                    elif magic[:4] == b"FORM":
+                        layout = _parse_aiff(fh, file_size)
+            if layout is not None and layout[5] >= layout[0] * layout[2]:
+                self._source = _MemmapSource(filepath, *layout)
+        except (OSError, ValueError, struct.error):
+            self._source = None
+
+        if self._source is None:
+            try:
+                self._source = _SoundFileSource(filepath)
+            except RuntimeError as e:
+                raise RuntimeError(f"Failed to read audio file '{filepath}': {e}")
+
+        if hasattr(os, "posix_fadvise"):
+            try:
+                self._hint_fd = os.open(filepath, os.O_RDONLY)
+            except OSError:
+                self._hint_fd = None
+
+    @property
+    def samplerate(self):
+        return self._source.samplerate
+
+    @property
+    def frames(self):
+        return self._source.frames
+
+    @property
+    def duration(self):
+        return self.frames / self.samplerate if self.samplerate else 0.0
+
+    @property
+    def is_memory_mapped(self):
+        return isinstance(self._source, _MemmapSource)
+
+    def read(self, start=0, count=None):
+        start = max(0, min(int(start), self.frames))
+        if count is None:
+            count = self.frames - start
+        count = max(0, min(int(count), self.frames - start))
+        return self._source.read(start, count)
+
+    def prefetch(self, ranges):
+        """Ask the kernel to start reading the data behind these (start, count) frame ranges.
+
+        Issued together, the reads can be sorted and merged by the I/O scheduler, and a memory
+        mapped window arrives in a few large reads instead of one page fault at a time.
+        """
+        if self._hint_fd is None:
+            return
+        for start, count in ranges:
+            start = max(0, min(int(start), self.frames))
+            count = max(0, min(int(count), self.frames - start))
+            if not count:
+                continue
+            offset, length = self._source.byte_range(start, count)
+            try:
+                os.posix_fadvise(self._hint_fd, offset, length, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                return
+
+    def fingerprint_samples(self, start_seconds=0.0, seconds=None):
+        """Return 16 kHz mono int16 samples for a window of the file, decoding nothing outside it."""
+        start = int(start_seconds * self.samplerate)
+        count = None if seconds is None else int(seconds * self.samplerate)
+        self.prefetch([(start, self.frames - start if count is None else count)])
+        try:
+            frames = self.read(start, count)
+        except RuntimeError as e:
+            raise RuntimeError(f"Failed to read audio file '{self.filepath}': {e}")
+        return to_fingerprint_samples(frames, self.samplerate)
+
+    @property
+    def fingerprint_length(self):
+        """Length of the whole file at 16 kHz, as fingerprint_range counts it."""
+        return self.frames * FINGERPRINT_SAMPLE_RATE // self.samplerate if self.samplerate else 0
+
+    def fingerprint_range(self, start, stop, block_seconds=10.0):
+        """Return samples [start, stop) of the whole file at 16 kHz mono int16, decoding only what they need.
+
+        The file is resampled in fixed blocks anchored at its start, each with neighbouring input
+        (silence beyond either end) covering resampy's filter, so a range comes out bit-identical
+        however the file is split into ranges.
+        """
+        total = self.fingerprint_length
+        start = max(0, min(int(start), total))
+        stop = max(start, min(int(stop), total))
+        if self.samplerate == FINGERPRINT_SAMPLE_RATE:
+            self.prefetch([(start, stop - start)])
+            return to_fingerprint_samples(self.read(start, stop - start), self.samplerate)
+        if start == stop:
+            return np.zeros(0, dtype=np.int16)
+
+        import resampy
+
+        context, block = _resampling_grid(self.samplerate, block_seconds)
+        out_block = block * FINGERPRINT_SAMPLE_RATE // self.samplerate
+        skip = context * FINGERPRINT_SAMPLE_RATE // self.samplerate
+        first_block = start // out_block
+        blocks = -(-stop // out_block) - first_block
+
+        in_start = first_block * block - context
+        samples = np.zeros(blocks * block + 2 * context, dtype=np.float32)
+        read_start = max(0, in_start)
+        count = min(self.frames, in_start + len(samples)) - read_start
+        self.prefetch([(read_start, count)])
+        try:
+            frames = self.read(read_start, count)
+        except RuntimeError as e:
+            raise RuntimeError(f"Failed to read audio file '{self.filepath}': {e}")
+        samples[read_start - in_start:read_start - in_start + len(frames)] = to_float_mono(frames)
+
+        resampled = np.concatenate([
+            resampy.resample(samples[index * block:(index + 1) * block + 2 * context],
+                             self.samplerate, FINGERPRINT_SAMPLE_RATE)[skip:skip + out_block]
+            for index in range(blocks)
+        ])
+        offset = start - first_block * out_block
+        resampled = np.clip(resampled[offset:offset + stop - start], -1.0, 1.0)
+        return (resampled * 32767).astype(np.int16)
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._hint_fd is not None:
+            os.close(self._hint_fd)
+            self._hint_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_fingerprint_range(filepath, start, stop):
+    """AudioSource.fingerprint_range for one range of filepath; picklable for use in worker processes."""
+    with AudioSource(filepath) as source:
+        return source.fingerprint_range(start, stop)
+
+
+def to_float_mono(samples):
+    orig_kind = samples.dtype.kind
+    orig_dtype = samples.dtype
+
+    if samples.ndim > 1:
+        # Only the requested window is materialised here, the rest of a mapped file is never touched
+        samples = samples[:, 0] if samples.shape[1] == 1 else np.mean(samples, axis=1, dtype=np.float32)
+
+    # Normalize integer PCM to float in [-1, 1] before resampling to avoid wraparound and DC edge ringing
+    if orig_kind in {'i', 'u'}:
+        info = np.iinfo(orig_dtype)
+        samples = samples.astype('float32')
+        if orig_kind == 'u':
+            midpoint = info.max / 2.0
+            samples = (samples - midpoint) / midpoint
+        else:
+            max_int = max(abs(info.min), info.max) or 1
+            samples = samples / max_int
+
+    return samples
+
+
+def to_fingerprint_samples(samples, samplerate):
+    samples = to_float_mono(samples)
+
+    if samplerate != FINGERPRINT_SAMPLE_RATE and len(samples):
+        # resampy pulls in numba, which is the single most expensive import on the startup path
+        import resampy
+
+        samples = resampy.resample(samples.astype('float32'), samplerate, FINGERPRINT_SAMPLE_RATE)
+
+    samples = np.clip(samples, -1.0, 1.0)
+    samples = (samples * 32767).astype(np.int16)
+
+    return samples
+
+
+def _resampling_grid(samplerate, block_seconds, filter_zeros=64):
+    """(context, block) input lengths for block-wise resampling to 16 kHz.
+
+    Both are multiples of the input/output rate period, so every block's output starts on the
+    16 kHz grid, and the context covers resampy's filter on either side of a block.
+    """
+    in_period = samplerate // gcd(samplerate, FINGERPRINT_SAMPLE_RATE)
+    half_width = filter_zeros * max(1.0, samplerate / FINGERPRINT_SAMPLE_RATE) + 1
+    context = ceil(half_width / in_period) * in_period
+    block = max(1, round(block_seconds * samplerate / in_period)) * in_period
+    return context, block
+
+
+class StreamingResampler:
+    """Resample an unbounded mono float stream to 16 kHz in fixed blocks with constant memory.
+
+    Blocks are cut on multiples of the input/output rate period so every block's output lands
+    exactly on the global 16 kHz grid, and each is resampled together with enough neighbouring
+    input to cover resampy's filter, whose edge output is then discarded. Away from the very
+    start of the stream the result matches resampling the whole stream in one go.
+    """
+
+    def __init__(self, samplerate, block_seconds=0.5, filter_zeros=64):
+        self.samplerate = samplerate
+        self._ratio = FINGERPRINT_SAMPLE_RATE / samplerate
+        self._context, self._block = _resampling_grid(samplerate, block_seconds, filter_zeros)
+        # Leading silence stands in for the audio before the stream started
+        self._buffer = np.zeros(self._context, dtype=np.float32)
+
+    @property
+    def latency_seconds(self):
+        return (self._block + self._context) / self.samplerate
+
+    def process(self, samples):
+        """Feed float samples and return whatever 16 kHz output is complete so far."""
+        if self.samplerate == FINGERPRINT_SAMPLE_RATE:
+            return np.asarray(samples, dtype=np.float32)
+
+        import resampy
+
+        self._buffer = np.concatenate([self._buffer, np.asarray(samples, dtype=np.float32)])
+        span = self._block + 2 * self._context
+        skip = round(self._context * self._ratio)
+        keep = round(self._block * self._ratio)
+
+        output = []
+        while len(self._buffer) >= span:
+            resampled = resampy.resample(self._buffer[:span], self.samplerate, FINGERPRINT_SAMPLE_RATE)
+            output.append(resampled[skip:skip + keep])
+            self._buffer = self._buffer[self._block:]
+
+        return np.concatenate(output) if output else np.zeros(0, dtype=np.float32)
+
+
+def _probe_score(samples, samplerate):
+    """Cheap proxy for how many spectral peaks a stretch of audio will yield.
+
+    Works on a naively decimated ~16 kHz stream: the mean positive log-spectral flux in the
+    250-5500 Hz range the fingerprint uses, scaled by the fraction of non-silent frames.
+    """
+    step = max(1, samplerate // FINGERPRINT_SAMPLE_RATE)
+    mono = to_float_mono(samples)[::step]
+    rate = samplerate / step
+
+    frame_size, hop = 512, 256
+    if len(mono) < frame_size + hop:
+        return 0.0
+
+    count = 1 + (len(mono) - frame_size) // hop
+    frames = np.lib.stride_tricks.as_strided(
+        mono, shape=(count, frame_size), strides=(mono.strides[0] * hop, mono.strides[0])
+    )
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+    active_fraction = float(np.mean(rms > 1e-3))
+    if not active_fraction:
+        return 0.0
+
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_size).astype(np.float32), axis=1))
+    low_bin = int(250 * frame_size / rate)
+    high_bin = min(spectrum.shape[1], int(5500 * frame_size / rate) + 1)
+    log_spectrum = np.log1p(1000 * spectrum[:, low_bin:high_bin])
+    flux = np.maximum(np.diff(log_spectrum, axis=0), 0).sum(axis=1)
+
+    return float(np.mean(flux)) * active_fraction
+
+
+def rank_windows(source, window_seconds, candidates=8, probes_per_window=2, probe_seconds=0.5):
+    """Return candidate window start offsets in seconds, the most promising first.
+
+    Candidates are spread over the middle 80% of the track (skipping intros and outros as the
+    old fixed centre window did). Each is scored from a few short probes, so the pre-pass
+    decodes candidates * probes_per_window * probe_seconds of audio regardless of file length.
+    Ties, including all-silent input, fall back to the window closest to the centre.
+    """
+    duration = source.duration
+    centre = max(0.0, duration / 2 - window_seconds / 2)
+    first = duration * 0.1
+    last = duration * 0.9 - window_seconds
+    if last <= first or candidates <= 1:
+        return [centre]
+
+    starts = sorted({*np.linspace(first, last, candidates).tolist(), centre})
+    probe_frames = int(probe_seconds * source.samplerate)
+    probes = {
+        start: np.linspace(start, start + window_seconds - probe_seconds, probes_per_window)
+        for start in starts
+    }
+    source.prefetch((offset * source.samplerate, probe_frames) for offsets in probes.values() for offset in offsets)
+
+    scores = {}
+    for start, probe_offsets in probes.items():
+        scores[start] = sum(
+            _probe_score(source.read(offset * source.samplerate, probe_frames), source.samplerate)
+            for offset in probe_offsets
+        )
+
+    return sorted(starts, key=lambda start: (-round(scores[start], 6), abs(start - centre)))
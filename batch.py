@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import base64
+import logging
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from utils import _is_within_directory, SUPPORTED_FORMATS
+
+SIGNATURES_FORMAT = "metaaudio-signatures"
+RESULTS_FORMAT = "metaaudio-results"
+FORMAT_VERSION = 1
+
+
+def _file_identity(filepath, base_dir):
+    stat = filepath.stat()
+    return {
+        "path": filepath.relative_to(base_dir).as_posix(),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+class _ShardWriter:
+    """Write one JSON record per line into numbered shards, each renamed into place only once complete."""
+
+    def __init__(self, directory, prefix, file_format, records_per_shard):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.file_format = file_format
+        self.records_per_shard = records_per_shard
+        self._handle = None
+        self._count = 0
+        existing = [int(path.stem.rsplit("-", 1)[1]) for path in self.directory.glob(f"{prefix}-*.jsonl")]
+        self._index = max(existing, default=-1) + 1
+
+    def _path(self, index, partial=False):
+        return self.directory / f"{self.prefix}-{index:05d}.jsonl{'.partial' if partial else ''}"
+
+    def write(self, record):
+        if self._handle is None:
+            self._handle = self._path(self._index, partial=True).open("w", encoding="utf-8")
+            self._handle.write(json.dumps({"format": self.file_format, "version": FORMAT_VERSION}) + "\n")
+        self._handle.write(json.dumps(record) + "\n")
+        self._count += 1
+        if self._count >= self.records_per_shard:
+            self.close()
+
+    def close(self):
+        if self._handle is None:
+            return
+        self._handle.close()
+        self._path(self._index, partial=True).replace(self._path(self._index))
+        self._handle = None
+        self._count = 0
+        self._index += 1
+
+
+def _read_shard(path, file_format):
+    with path.open(encoding="utf-8") as handle:
+        header = json.loads(handle.readline() or "{}")
+        if header.get("format") != file_format or header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path.name} is not a version {FORMAT_VERSION} {file_format} file")
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _signature_entry(start_seconds, signature):
+    return {
+        "window": start_seconds,
+        "samplems": int(signature.number_samples / signature.sample_rate_hz * 1000),
+        "data": base64.b64encode(signature.encode_to_binary()).decode("ascii"),
+    }
+
+
+def _fingerprint_file(filepath, base_dir, max_windows):
+    from metaaudio import plan_recognition_windows, iter_signatures, read_signature_tag
+
+    identity = _file_identity(filepath, base_dir)
+    try:
+        stored = read_signature_tag(filepath)
+    except Exception:
+        stored = None
+    if stored is not None:
+        # Stored by an earlier --store-signature run, so no audio needs decoding
+        return {"file": identity, "signatures": [dict(_signature_entry(*stored), stored=True)]}
+
+    window_starts = plan_recognition_windows(filepath)[:max(1, max_windows)]
+    signatures = [_signature_entry(start_seconds, signature) for start_seconds, signature in iter_signatures(filepath, window_starts)]
+    return {"file": identity, "signatures": signatures}
+
+
+def _fingerprint_file_full(filepath, base_dir, executor):
+    from functools import partial
+    from audio import AudioSource, read_fingerprint_range
+    from recognition.parallel import generate_segmented_signature
+
+    identity = _file_identity(filepath, base_dir)
+    # Only the header is read here; each worker decodes and resamples just its own segment
+    with AudioSource(filepath) as source:
+        total_samples = source.fingerprint_length
+    signature = generate_segmented_signature(partial(read_fingerprint_range, str(filepath)), total_samples,
+                                             executor=executor)
+    signatures = [] if signature is None else [dict(_signature_entry(None, signature), full=True)]
+    return {"file": identity, "signatures": signatures}
+
+
+def fingerprint(args):
+    from metaaudio import get_existing_artist, order_by_cost, untaggable_reason
+
+    input_dir = Path(args.input_dir)
+    if not input_dir.is_dir():
+        print(f"Directory not found: {input_dir}", file=sys.stderr)
+        sys.exit(1)
+    base_dir = input_dir.resolve()
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    pending = []
+    for filepath in sorted(input_dir.glob("*")):
+        if filepath.suffix.lower() not in SUPPORTED_FORMATS:
+            continue
+        if filepath.is_symlink() or not _is_within_directory(filepath, base_dir):
+            print(f"Skipping {filepath.name}: symlinked or outside the target directory", file=sys.stderr)
+            continue
+        filepath = filepath.resolve()
+        reason = untaggable_reason(filepath)
+        if reason:
+            print(f"Skipping {filepath.name}: {reason}", file=sys.stderr)
+            continue
+        if not args.include_tagged:
+            try:
+                artist = get_existing_artist(filepath)
+            except Exception:
+                artist = None
+            if artist and artist.strip().lower() != 'unknown':
+                print(f"Skipping {filepath.name}: artist metadata already set to '{artist}'")
+                continue
+        pending.append(filepath)
+
+    pending = order_by_cost(pending)
+    writer = _ShardWriter(output_dir, "signatures", SIGNATURES_FORMAT, args.shard_size)
+    written = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        if args.full_length:
+            # One file at a time, each split into segments across all workers
+            jobs = ((filepath, lambda filepath=filepath: _fingerprint_file_full(filepath, base_dir, executor)) for filepath in pending)
+        else:
+            futures = [(filepath, executor.submit(_fingerprint_file, filepath, base_dir, args.windows)) for filepath in pending]
+            jobs = ((filepath, future.result) for filepath, future in futures)
+
+        for filepath, get_record in jobs:
+            try:
+                record = get_record()
+            except Exception as exc:
+                print(f"Could not fingerprint {filepath.name}: {exc}", file=sys.stderr)
+                continue
+            if not record["signatures"]:
+                print(f"No signature generated for {filepath.name}", file=sys.stderr)
+                continue
+            writer.write(record)
+            written += 1
+    writer.close()
+
+    print(f"Fingerprinted {written} of {len(pending)} files into {output_dir}")
+
+
+def _submit_record(record, options):
+    from metaaudio import RecognitionResult, Status, extract_metadata, recognise_signatures
+    from recognition.signature_format import DecodedMessage
+
+    result = RecognitionResult(path=Path(record["file"]["path"]), status=Status.FAILED)
+    matched = []
+
+    def signatures():
+        for entry in record["signatures"]:
+            matched[:] = [entry]
+            yield DecodedMessage.decode_from_binary(base64.b64decode(entry["data"]))
+
+    results = recognise_signatures(signatures(), options, result)
+    output = {"file": record["file"], "attempts": result.attempts}
+    if results is None:
+        output.update(status=result.status.value, error=result.error)
+    else:
+        output.update(
+            status=Status.TAGGED.value, window=matched[0]["window"], signature=matched[0]["data"],
+            metadata=extract_metadata(results),
+        )
+    return output
+
+
+def submit(args):
+    from metaaudio import RecognitionOptions
+
+    batch_dir = Path(args.batch_dir)
+    results_dir = Path(args.results_dir or args.batch_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    options = RecognitionOptions(delay=args.delay)
+
+    shards = sorted(batch_dir.glob("signatures-*.jsonl"))
+    if not shards:
+        print(f"No signature batches found in {batch_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for shard in shards:
+            results_path = results_dir / shard.name.replace("signatures-", "results-", 1)
+            if results_path.exists():
+                # Already submitted by an earlier (possibly interrupted) run
+                continue
+
+            records = list(_read_shard(shard, SIGNATURES_FORMAT))
+            partial_path = results_path.with_name(results_path.name + ".partial")
+            matched = 0
+            with partial_path.open("w", encoding="utf-8") as handle:
+                handle.write(json.dumps({"format": RESULTS_FORMAT, "version": FORMAT_VERSION}) + "\n")
+                for output in executor.map(lambda record: _submit_record(record, options), records):
+                    handle.write(json.dumps(output) + "\n")
+                    matched += output["status"] == "tagged"
+            partial_path.replace(results_path)
+            print(f"{shard.name}: {matched} of {len(records)} files recognised")
+
+
+def apply_tags(args):
+    from metaaudio import RecognitionOptions, encode_signature_tag, tag_file
+    from recognition.signature_format import DecodedMessage
+
+    results_dir = Path(args.results_dir)
+    library_dir = Path(args.library_dir)
+    if not library_dir.is_dir():
+        print(f"Directory not found: {library_dir}", file=sys.stderr)
+        sys.exit(1)
+    base_dir = library_dir.resolve()
+    options = RecognitionOptions(rename=args.rename, overwrite=args.overwrite, store_signature=args.store_signature)
+
+    for shard in sorted(results_dir.glob("results-*.jsonl")):
+        for record in _read_shard(shard, RESULTS_FORMAT):
+            identity = record["file"]
+            if record["status"] != "tagged":
+                print(f"Could not tag {identity['path']}: {record.get('error')}", file=sys.stderr)
+                continue
+
+            filepath = base_dir / identity["path"]
+            if filepath.is_symlink() or not _is_within_directory(filepath, base_dir):
+                print(f"Skipping {identity['path']}: symlinked or outside the target directory", file=sys.stderr)
+                continue
+            try:
+                current = _file_identity(filepath, base_dir)
+            except OSError:
+                print(f"Skipping {identity['path']}: file no longer exists", file=sys.stderr)
+                continue
+            if current != identity:
+                print(f"Skipping {identity['path']}: file changed since it was fingerprinted", file=sys.stderr)
+                continue
+
+            # One file that cannot be tagged must not stop the rest of the pass
+            try:
+                signature_tag = None
+                if record.get("signature"):
+                    signature = DecodedMessage.decode_from_binary(base64.b64decode(record["signature"]))
+                    signature_tag = encode_signature_tag(record.get("window"), signature)
+                final_path = tag_file(filepath.resolve(), record["metadata"], options, signature_tag)
+            except Exception as exc:
+                print(f"Could not tag {identity['path']}: {str(exc) or type(exc).__name__}", file=sys.stderr)
+                continue
+            if final_path.name != filepath.name:
+                print(f"Renamed file to {final_path.name}")
+            print(f"Finished writing metadata for {final_path.name}")
+
+
+def main():
+    parser = ArgumentParser(
+        prog="metaaudio-batch",
+        description="Run fingerprinting, recognition and tagging as separate stages through portable batch files"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fingerprint_parser = subparsers.add_parser("fingerprint", help="Fingerprint music files into sharded signature batches")
+    fingerprint_parser.add_argument("input_dir", help="The directory containing music files to fingerprint")
+    fingerprint_parser.add_argument("output_dir", help="The directory to write signatures-*.jsonl batches to")
+    fingerprint_parser.add_argument("--shard-size", type=int, default=500, help="Files per batch file (default: 500)")
+    fingerprint_parser.add_argument("--windows", type=int, default=2, help="Ranked recognition windows to fingerprint per long file (default: 2)")
+    fingerprint_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes (default: number of CPUs)")
+    fingerprint_parser.add_argument("--full-length", action="store_true", help="Fingerprint each whole file as one signature, splitting long files across the workers")
+    fingerprint_parser.add_argument("--include-tagged", action="store_true", help="Also fingerprint files that already have artist metadata")
+    fingerprint_parser.set_defaults(handler=fingerprint)
+
+    submit_parser = subparsers.add_parser("submit", help="Recognise signature batches and write result batches")
+    submit_parser.add_argument("batch_dir", help="The directory containing signatures-*.jsonl batches")
+    submit_parser.add_argument("--results-dir", help="The directory to write results-*.jsonl batches to (default: batch_dir)")
+    submit_parser.add_argument("--jobs", type=int, default=1, help="Concurrent recognition requests (default: 1)")
+    submit_parser.add_argument("--delay", type=float, default=0, help="Minimum seconds between files' first requests, shared by all --jobs (default: 0)")
+    submit_parser.add_argument("--hedge", type=float, metavar="PERCENTILE", help="Send a duplicate of any recognition request slower than this percentile of recent ones (e.g. 95)")
+    submit_parser.add_argument("--hedge-rate", type=float, default=0.1, help="Most duplicate requests --hedge may send, as a fraction of all requests (default: 0.1)")
+    submit_parser.set_defaults(handler=submit)
+
+    apply_parser = subparsers.add_parser("apply-tags", help="Write recognised metadata back to the music files")
+    apply_parser.add_argument("results_dir", help="The directory containing results-*.jsonl batches")
+    apply_parser.add_argument("library_dir", help="The directory the batches were fingerprinted from")
+    apply_parser.add_argument("--rename", action="store_true", help="Rename music files to '<artist> - <title>.<ext>' format")
+    apply_parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files when renaming (requires --rename)")
+    apply_parser.add_argument("--store-signature", action="store_true", help="Store the matching fingerprint in each tagged file so later fingerprint runs can reuse it")
+    apply_parser.set_defaults(handler=apply_tags)
+
+    args = parser.parse_args()
+
+    if getattr(args, "overwrite", False) and not args.rename:
+        print("--overwrite requires --rename; please specify both or remove --overwrite.", file=sys.stderr)
+        sys.exit(1)
+    if getattr(args, "shard_size", 1) < 1:
+        print("--shard-size must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+    if getattr(args, "hedge", None) is not None and not (0 < args.hedge < 100 and 0 <= args.hedge_rate <= 1):
+        print("--hedge must be between 0 and 100 and --hedge-rate between 0 and 1.", file=sys.stderr)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if getattr(args, "hedge", None) is not None:
+        from recognition.communication import configure_hedging
+
+        configure_hedging(args.hedge, args.hedge_rate)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
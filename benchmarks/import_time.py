@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Check that importing the CLI stays cheap: no heavy dependency is loaded until a file is processed."""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ("numpy", "resampy", "soundfile", "requests", "mutagen")
+
+IMPORT_CHECK = f"""
+import sys
+import metaaudio
+import recognition.communication
+loaded = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+if loaded:
+    sys.exit("imported at start-up: " + ", ".join(loaded))
+"""
+
+
+def check_imports():
+    completed = subprocess.run([sys.executable, "-c", IMPORT_CHECK], cwd=REPO, capture_output=True, text=True)
+    if completed.returncode:
+        return completed.stderr.strip() or f"import check exited with {completed.returncode}"
+    return None
+
+
+def time_help(runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, str(REPO / "metaaudio.py"), "--help"], cwd=REPO,
+                       check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check metaaudio's start-up cost.")
+    parser.add_argument("--budget", type=float, default=0.5,
+                        help="Maximum median seconds for `metaaudio.py --help` (default: 0.5)")
+    parser.add_argument("--runs", type=int, default=5, help="Number of timed runs (default: 5)")
+    args = parser.parse_args()
+
+    error = check_imports()
+    if error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    print(f"No heavy modules imported ({', '.join(HEAVY_MODULES)})")
+
+    timings = time_help(max(1, args.runs))
+    median = statistics.median(timings)
+    print(f"metaaudio.py --help: median {median:.3f}s, best {min(timings):.3f}s over {len(timings)} runs")
+    if median > args.budget:
+        print(f"metaaudio.py --help took {median:.3f}s, over the {args.budget:.3f}s budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+PCM_FORMATS = {"s16le": "<i2", "s32le": "<i4", "f32le": "<f4"}
+
+logger = logging.getLogger("metaaudio.live")
+
+
+def _format_timestamp(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+class LiveRecogniser:
+    """Fingerprint the last `window` seconds of a PCM stream every `hop` seconds and report track changes.
+
+    Fingerprinting runs on its own thread and recognition on a small thread pool, so reading
+    the stream never waits on either. A hop that comes up while the previous window is still
+    being fingerprinted, or while max_in_flight requests are outstanding, is skipped rather
+    than queued, which keeps latency bounded. Memory is constant: only the window being
+    fingerprinted, one window of 16 kHz audio and one resampler block are held at any time.
+    """
+
+    def __init__(self, samplerate, channels, dtype, window=8.0, hop=4.0, max_in_flight=2, emit=print, as_json=False):
+        import numpy as np
+        from audio import StreamingResampler, FINGERPRINT_SAMPLE_RATE
+
+        self._np = np
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = self.dtype.itemsize * channels
+        self.window_samples = int(window * FINGERPRINT_SAMPLE_RATE)
+        self.hop_samples = int(hop * FINGERPRINT_SAMPLE_RATE)
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.emit = emit
+        self.as_json = as_json
+
+        self._resampler = StreamingResampler(samplerate)
+        self._ring = np.zeros(self.window_samples, dtype=np.int16)
+        self._filled = 0
+        self._since_hop = 0
+        self._stream_samples = 0
+        self._pending_bytes = b""
+
+        self._fingerprinter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fingerprint")
+        self._fingerprinting = threading.BoundedSemaphore(1)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._current = None
+        self._latest_reported = -1.0
+
+    def feed(self, data):
+        """Consume raw PCM bytes, which need not be aligned to whole frames."""
+        from audio import to_float_mono
+
+        np = self._np
+        data = self._pending_bytes + data
+        usable = len(data) - len(data) % self.frame_bytes
+        self._pending_bytes = data[usable:]
+        if not usable:
+            return
+
+        frames = np.frombuffer(data[:usable], dtype=self.dtype).reshape(-1, self.channels)
+        resampled = self._resampler.process(to_float_mono(frames))
+        self._append(np.clip(resampled * 32767, -32768, 32767).astype(np.int16))
+
+    def _append(self, samples):
+        np = self._np
+        while len(samples):
+            take = min(len(samples), self.hop_samples - self._since_hop)
+            chunk, samples = samples[:take], samples[take:]
+
+            self._ring = np.roll(self._ring, -len(chunk))
+            self._ring[-len(chunk):] = chunk
+            self._filled = min(self.window_samples, self._filled + len(chunk))
+            self._since_hop += len(chunk)
+            self._stream_samples += len(chunk)
+
+            if self._since_hop >= self.hop_samples and self._filled >= self.window_samples:
+                self._since_hop = 0
+                self._fingerprint()
+            elif self._since_hop >= self.hop_samples:
+                self._since_hop = 0
+
+    def _fingerprint(self):
+        from audio import FINGERPRINT_SAMPLE_RATE
+
+        if not self._fingerprinting.acquire(blocking=False):
+            logger.info("Fingerprinting is falling behind, skipping this hop")
+            return
+        if not self._in_flight.acquire(blocking=False):
+            self._fingerprinting.release()
+            logger.info("Recognition is falling behind, skipping this hop")
+            return
+
+        stream_time = self._stream_samples / FINGERPRINT_SAMPLE_RATE
+        self._fingerprinter.submit(self._fingerprint_window, self._ring.copy(), stream_time)
+
+    def _fingerprint_window(self, samples, stream_time):
+        from recognition.algorithm import SignatureGenerator
+
+        try:
+            signature_generator = SignatureGenerator()
+            signature_generator.MAX_TIME_SECONDS = self.window
+            signature_generator.feed_input(samples)
+            signature = signature_generator.get_next_signature()
+        except Exception as exc:
+            logger.warning(f"Fingerprinting failed at {_format_timestamp(stream_time)}: {exc}")
+            signature = None
+        finally:
+            self._fingerprinting.release()
+
+        if not signature:
+            self._in_flight.release()
+            return
+
+        future = self._executor.submit(self._recognise, signature, stream_time)
+        future.add_done_callback(lambda _: self._in_flight.release())
+
+    def _recognise(self, signature, stream_time):
+        from metaaudio import extract_metadata
+        from recognition.communication import recognise_song_from_signature
+
+        results = recognise_song_from_signature(signature)
+        if results.get("error"):
+            logger.warning(f"Recognition error at {_format_timestamp(stream_time)}: {results['error']}")
+            return
+        if not results.get("matches"):
+            logger.info(f"No match at {_format_timestamp(stream_time)}")
+            return
+
+        metadata = extract_metadata(results)
+        track = (metadata["artist"], metadata["title"])
+        with self._lock:
+            # Responses can arrive out of order; never let an older window override a newer one
+            if stream_time < self._latest_reported:
+                return
+            self._latest_reported = stream_time
+            if track == self._current:
+                return
+            self._current = track
+
+        if self.as_json:
+            self.emit(json.dumps({"stream_time": round(stream_time, 3), "wall_time": time.time(), **metadata}))
+        else:
+            self.emit(f"[{_format_timestamp(stream_time)}] {metadata['artist']} - {metadata['title']}")
+
+    def close(self):
+        # The fingerprinter hands its last signature to the executor, so it has to finish first
+        self._fingerprinter.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+
+
+def main():
+    parser = ArgumentParser(
+        prog="metaaudio-live",
+        description="Recognise songs in a live raw PCM stream (e.g. a radio capture piped from ffmpeg) and report track changes"
+    )
+    parser.add_argument("input", nargs="?", default="-", help="A FIFO or file to read PCM from (default: stdin)")
+    parser.add_argument("--format", choices=sorted(PCM_FORMATS), default="s16le", help="Sample format (default: s16le)")
+    parser.add_argument("--rate", type=int, default=44100, help="Sample rate in Hz (default: 44100)")
+    parser.add_argument("--channels", type=int, default=2, help="Number of interleaved channels (default: 2)")
+    parser.add_argument("--window", type=float, default=8.0, help="Seconds of audio per signature (default: 8)")
+    parser.add_argument("--hop", type=float, default=4.0, help="Seconds between signatures (default: 4)")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="Recognition requests allowed at once before hops are skipped (default: 2)")
+    parser.add_argument("--json", action="store_true", help="Print track changes as JSON lines")
+    args = parser.parse_args()
+
+    if args.rate <= 0 or args.channels <= 0 or args.window <= 0 or args.hop <= 0 or args.max_in_flight < 1:
+        print("--rate, --channels, --window, --hop and --max-in-flight must be positive.", file=sys.stderr)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    recogniser = LiveRecogniser(
+        args.rate, args.channels, PCM_FORMATS[args.format],
+        window=args.window, hop=args.hop, max_in_flight=args.max_in_flight,
+        emit=lambda line: print(line, flush=True), as_json=args.json,
+    )
+    # About a tenth of a second per read keeps the resampler and hop schedule responsive
+    read_size = max(recogniser.frame_bytes, int(args.rate / 10) * recogniser.frame_bytes)
+
+    stream = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        while True:
+            data = stream.read1(read_size) if hasattr(stream, "read1") else stream.read(read_size)
+            if not data:
+                break
+            recogniser.feed(data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recogniser.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,41 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-import requests
-import numpy as np
-import resampy
-import soundfile as sf
+import math
 import time
+import struct
+import base64
 import socket
+import logging
+import threading
 import ipaddress
 from urllib.parse import urlparse
+from functools import lru_cache
+from itertools import islice
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, Iterator, Optional
 
 from pathlib import Path
 from argparse import ArgumentParser
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3
-from mutagen.id3._frames import APIC, TIT2, TPE1, TALB, TCON, TPUB, TYER, TDRC
 
-from recognition.communication import recognise_song_from_signature
-from recognition.algorithm import SignatureGenerator
-from utils import _is_within_directory
+from utils import _is_within_directory, SUPPORTED_FORMATS
+
+# numpy, resampy (numba), soundfile, requests and mutagen are imported where they are
+# first used so that `--help` and runs with nothing to do stay fast
 
 MAX_COVERART_BYTES = 5 * 1024 * 1024
+RECOGNITION_WINDOW_SECONDS = 12
+
+# Signatures stored in a file's own tags: an ID3 PRIV frame owned by SIGNATURE_TAG, or a
+# base64 Vorbis comment of that name in FLAC. Bump SIGNATURE_TAG_VERSION whenever the
+# windowing or resampling changes so older stored signatures are recomputed.
+SIGNATURE_TAG = "metaaudio_signature"
+SIGNATURE_TAG_VERSION = 1
+_SIGNATURE_TAG_HEADER = struct.Struct("<Bd")
+
+logger = logging.getLogger("metaaudio")
 
 
 def _is_public_host(host: str) -> bool:
@@ -74,46 +89,62 @@ def _is_public_host(host: str) -> bool:
     return public_found
 
 
+@lru_cache(maxsize=None)
+def _coverart_session():
+    import requests
+
+    # Shared so that long-running modes keep their connections to the artwork CDN alive
+    return requests.Session()
+
+
 def download_cover_art(url, filepath):
     if not url:
         return None
 
     parsed = urlparse(url)
     if parsed.scheme not in {"http", "https"} or not parsed.netloc:
-        print(f"Skipping cover art: unsupported URL {url}", file=sys.stderr)
+        logger.warning(f"Skipping cover art: unsupported URL {url}")
         return None
 
     hostname = parsed.hostname
     if not hostname or not _is_public_host(hostname):
-        print(f"Skipping cover art: non-public host {hostname or '[missing]'}", file=sys.stderr)
+        logger.warning(f"Skipping cover art: non-public host {hostname or '[missing]'}")
         return None
 
-    coverart_path = filepath.with_suffix('.jpeg')
+    import requests
+    import tempfile
+
+    coverart_path = None
 
     try:
-        with requests.get(url, timeout=10, stream=True) as response:
+        with _coverart_session().get(url, timeout=10, stream=True) as response:
             response.raise_for_status()
 
             content_type = response.headers.get("Content-Type", "").lower()
             content_base = content_type.split(";", 1)[0].strip()
             if not (content_base.startswith("image/jpeg") or content_base.startswith("image/jpg")):
-                print(f"Skipping cover art: unsupported content type {content_type or '[missing]'}", file=sys.stderr)
+                logger.warning(f"Skipping cover art: unsupported content type {content_type or '[missing]'}")
                 return None
 
             total_bytes = 0
-            with coverart_path.open("wb") as buffer:
+            # A private file per download: siblings such as x.mp3 and x.flac may be tagged at the same time,
+            # and a user's own x.jpeg must not be touched
+            with tempfile.NamedTemporaryFile(dir=filepath.parent, prefix=".metaaudio-", suffix=".jpeg", delete=False) as buffer:
+                coverart_path = Path(buffer.name)
                 for chunk in response.iter_content(chunk_size=8192):
                     if not chunk:
                         continue
                     total_bytes += len(chunk)
                     if total_bytes > MAX_COVERART_BYTES:
-                        print(f"Skipping cover art: exceeds {MAX_COVERART_BYTES} bytes limit", file=sys.stderr)
+                        logger.warning(f"Skipping cover art: exceeds {MAX_COVERART_BYTES} bytes limit")
+                        buffer.close()
                         coverart_path.unlink(missing_ok=True)
                         return None
                     buffer.write(chunk)
     except (requests.RequestException, OSError):
-        print("Skipping cover art: download error", file=sys.stderr)
-        coverart_path.unlink(missing_ok=True)
+        logger.warning("Skipping cover art: download error")
+        if coverart_path is not None:
+            coverart_path.unlink(missing_ok=True)
         return None
 
     return coverart_path
@@ -149,25 +180,70 @@ def extract_metadata(results):
     }
 
 
-def set_mp3_metadata(filepath, metadata, coverart_path):
-    audio = MP3(filepath, ID3=ID3)
+def encode_signature_tag(window, signature):
+    """Pack a signature and the window it was taken from (None for the file start) into tag bytes."""
+    start_seconds = math.nan if window is None else float(window)
+    return _SIGNATURE_TAG_HEADER.pack(SIGNATURE_TAG_VERSION, start_seconds) + signature.encode_to_binary()
 
-    if audio.tags is None:
-        audio.tags = ID3()
+
+def decode_signature_tag(data):
+    """Return (window, signature) from tag bytes, or None if they are from another version or unreadable."""
+    from recognition.signature_format import DecodedMessage
+
+    if len(data) <= _SIGNATURE_TAG_HEADER.size:
+        return None
+    version, start_seconds = _SIGNATURE_TAG_HEADER.unpack_from(data)
+    if version != SIGNATURE_TAG_VERSION:
+        return None
+    try:
+        signature = DecodedMessage.decode_from_binary(data[_SIGNATURE_TAG_HEADER.size:])
+    except Exception:
+        return None
+    return (None if math.isnan(start_seconds) else start_seconds), signature
+
+
+def _stored_signature(audio):
+    from mutagen.flac import FLAC
+
+    if audio is None or audio.tags is None:
+        return None
+    if isinstance(audio, FLAC):
+        values = audio.tags.get(SIGNATURE_TAG)
+        if not values:
+            return None
+        try:
+            return decode_signature_tag(base64.b64decode(values[0]))
+        except ValueError:
+            return None
+    for frame in audio.tags.getall("PRIV"):
+        if frame.owner == SIGNATURE_TAG:
+            return decode_signature_tag(frame.data)
+    return None
+
+
+def read_signature_tag(filepath):
+    """Return the (window, signature) stored in filepath's tags without decoding any audio, or None."""
+    from mutagen import File as MutagenFile
+
+    return _stored_signature(MutagenFile(filepath))
+
+
+def _set_id3_frames(tags, metadata, coverart_path, signature_tag=None):
+    from mutagen.id3._frames import APIC, TIT2, TPE1, TALB, TCON, TPUB, TYER, TDRC, PRIV
 
     for frame in ("TIT2", "TPE1", "TALB", "TCON", "TPUB", "TYER", "TDRC", "APIC"):
-        audio.tags.delall(frame)
+        tags.delall(frame)
 
-    audio.tags.add(TIT2(encoding=3, text=metadata["title"]))
-    audio.tags.add(TPE1(encoding=3, text=metadata["artist"]))
-    audio.tags.add(TALB(encoding=3, text=metadata["album"]))
-    audio.tags.add(TCON(encoding=3, text=metadata["genre"]))
-    audio.tags.add(TPUB(encoding=3, text=metadata["label"]))
-    audio.tags.add(TYER(encoding=3, text=metadata["year"]))
-    audio.tags.add(TDRC(encoding=3, text=metadata["year"]))
+    tags.add(TIT2(encoding=3, text=metadata["title"]))
+    tags.add(TPE1(encoding=3, text=metadata["artist"]))
+    tags.add(TALB(encoding=3, text=metadata["album"]))
+    tags.add(TCON(encoding=3, text=metadata["genre"]))
+    tags.add(TPUB(encoding=3, text=metadata["label"]))
+    tags.add(TYER(encoding=3, text=metadata["year"]))
+    tags.add(TDRC(encoding=3, text=metadata["year"]))
 
     if coverart_path and coverart_path.exists():
-        audio.tags.add(
+        tags.add(
             APIC(
                 encoding=3,
                 mime="image/jpeg",
@@ -176,195 +252,899 @@ def set_mp3_metadata(filepath, metadata, coverart_path):
                 data=coverart_path.read_bytes()
             )
         )
+
+    if signature_tag:
+        for key in [key for key, frame in tags.items() if frame.FrameID == "PRIV" and frame.owner == SIGNATURE_TAG]:
+            del tags[key]
+        tags.add(PRIV(owner=SIGNATURE_TAG, data=signature_tag))
+
+
+def set_mp3_metadata(filepath, metadata, coverart_path, signature_tag=None):
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3
+
+    audio = MP3(filepath, ID3=ID3)
+
+    if audio.tags is None:
+        audio.tags = ID3()
+
+    _set_id3_frames(audio.tags, metadata, coverart_path, signature_tag)
+    if coverart_path and coverart_path.exists():
         coverart_path.unlink()
 
     audio.save()
 
 
-def load_audio(filepath):
+def untaggable_reason(filepath):
+    """Why filepath's tags cannot be written, or None; checked before a recognition request is spent on it."""
+    if filepath.suffix.lower() != ".wav":
+        return None
     try:
-        samples, samplerate = sf.read(filepath, always_2d=False)
-    except RuntimeError as e:
-        raise RuntimeError(f"Failed to read audio file '{filepath}': {e}")
-
-    if samples.ndim > 1:
-        samples = np.mean(samples, axis=1)
-
-    orig_kind = samples.dtype.kind
-    orig_dtype = samples.dtype
-
-    if samplerate != 16000:
-        samples = resampy.resample(samples.astype('float32'), samplerate, 16000)
-
-    # Normalize integer PCM to float in [-1, 1] to avoid wraparound
-    if orig_kind in {'i', 'u'}:
-        info = np.iinfo(orig_dtype)
-        samples = samples.astype('float32')
-        if orig_kind == 'u':
-            midpoint = info.max / 2.0
-            samples = (samples - midpoint) / midpoint
-        else:
-            max_int = max(abs(info.min), info.max) or 1
-            samples = samples / max_int
+        with open(filepath, "rb") as fh:
+            magic = fh.read(4)
+    except OSError:
+        return None
+    if magic == b"RF64":
+        # mutagen only writes RIFF WAV, and RF64 is how WAV files over 4 GiB are stored
+        return "RF64 WAV files cannot be tagged"
+    return None
 
-    samples = np.clip(samples, -1.0, 1.0)
-    samples = (samples * 32767).astype(np.int16)
 
-    return samples
+def set_iff_metadata(filepath, metadata, coverart_path, signature_tag=None):
+    from mutagen.wave import WAVE
+    from mutagen.aiff import AIFF
 
+    # WAV and AIFF carry their tags as an embedded ID3 chunk
+    audio = WAVE(filepath) if filepath.suffix.lower() == ".wav" else AIFF(filepath)
 
-def main():
-    parser = ArgumentParser(
-        prog="metaaudio",
-        description="Generate a Shazam fingerprint from a sound file, perform song recognition towards Shazam's servers and append the metadata to the audio file (only .MP3 files are supported)"
-    )
-    parser.add_argument("input_dir", help="The directory containing .MP3 files to recognise")
-    parser.add_argument("--rename", action="store_true", help="Rename MP3 files to '<artist> - <title>.mp3' format")
-    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files when renaming (requires --rename)")
-    parser.add_argument("--delay", type=float, default=0, help="Delay in seconds between processing files (default: 0)")
-    args = parser.parse_args()
+    if audio.tags is None:
+        audio.add_tags()
 
-    if args.overwrite and not args.rename:
-        print("--overwrite requires --rename; please specify both or remove --overwrite.", file=sys.stderr)
-        sys.exit(1)
-    input_dir = Path(args.input_dir)
+    _set_id3_frames(audio.tags, metadata, coverart_path, signature_tag)
+    if coverart_path and coverart_path.exists():
+        coverart_path.unlink()
 
-    if not input_dir.is_dir():
-        print(f"Directory not found: {input_dir}", file=sys.stderr)
-        sys.exit(1)
+    audio.save()
 
-    mp3_files = list(input_dir.glob("*.mp3"))
 
-    if not mp3_files:
-        print("No MP3 files found in the specified directory.", file=sys.stderr)
-        sys.exit(1)
+def set_flac_metadata(filepath, metadata, coverart_path, signature_tag=None):
+    from mutagen.flac import FLAC, Picture
 
-    base_dir = input_dir.resolve()
+    audio = FLAC(filepath)
 
-    for filepath in mp3_files:
+    audio["title"] = metadata["title"]
+    audio["artist"] = metadata["artist"]
+    audio["album"] = metadata["album"]
+    audio["genre"] = metadata["genre"]
+    audio["organization"] = metadata["label"]
+    audio["date"] = metadata["year"]
+    if signature_tag:
+        audio[SIGNATURE_TAG] = base64.b64encode(signature_tag).decode("ascii")
+
+    audio.clear_pictures()
+    if coverart_path and coverart_path.exists():
+        picture = Picture()
+        picture.type = 3
+        picture.mime = "image/jpeg"
+        picture.desc = "Cover"
+        picture.data = coverart_path.read_bytes()
+        audio.add_picture(picture)
+        coverart_path.unlink()
+
+    audio.save()
 
-        if filepath.is_symlink():
-            print(f"Skipping {filepath.name}: symlinked files are not processed", file=sys.stderr)
-            continue
 
+def set_metadata(filepath, metadata, coverart_path, signature_tag=None):
+    file_ext = filepath.suffix.lower()
+    if file_ext == ".mp3":
+        set_mp3_metadata(filepath, metadata, coverart_path, signature_tag)
+    elif file_ext == ".flac":
+        set_flac_metadata(filepath, metadata, coverart_path, signature_tag)
+    else:
+        set_iff_metadata(filepath, metadata, coverart_path, signature_tag)
+
+
+def _existing_artist(audio):
+    from mutagen.flac import FLAC
+
+    if audio is None or audio.tags is None:
+        return None
+    if isinstance(audio, FLAC):
+        values = audio.tags.get("artist")
+        return values[0] if values else None
+    if 'TPE1' in audio.tags:
+        return audio.tags['TPE1'].text[0]
+    return None
+
+
+def get_existing_artist(filepath):
+    from mutagen import File as MutagenFile
+
+    return _existing_artist(MutagenFile(filepath))
+
+
+def read_tags(filepath):
+    """Return (existing artist, stored signature) from a single read of filepath's tags."""
+    from mutagen import File as MutagenFile
+
+    audio = MutagenFile(filepath)
+    return _existing_artist(audio), _stored_signature(audio)
+
+
+def plan_recognition_windows(filepath):
+    """Return the window start offsets (seconds) to fingerprint, most promising first.
+
+    Files up to 36 s are fingerprinted whole, which is signalled by a single None.
+    """
+    from audio import AudioSource, rank_windows
+
+    with AudioSource(filepath) as source:
+        if source.duration <= 36:
+            return [None]
+        return rank_windows(source, RECOGNITION_WINDOW_SECONDS)
+
+
+def read_recognition_window(filepath, start_seconds=None):
+    """Return the 16 kHz mono samples of one recognition window (the whole file when start_seconds is None)."""
+    from audio import AudioSource
+
+    # Only the recognition window is decoded; uncompressed PCM is read through a memory map
+    with AudioSource(filepath) as source:
+        if start_seconds is None:
+            return source.fingerprint_samples()
+        return source.fingerprint_samples(start_seconds, RECOGNITION_WINDOW_SECONDS)
+
+
+class Status(str, Enum):
+    TAGGED = "tagged"
+    ALREADY_TAGGED = "already_tagged"
+    SKIPPED = "skipped"
+    NO_MATCH = "no_match"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+
+
+@dataclass
+class RecognitionOptions:
+    rename: bool = False
+    overwrite: bool = False
+    delay: float = 0.0
+    max_retries: int = 3
+    # Ranked windows to try on long files before giving up on a match
+    max_windows: int = 2
+    # When set, files resolving outside this directory are skipped
+    base_dir: Optional[Path] = None
+    # Keep the matching signature in the file's tags so later runs need not decode it again
+    store_signature: bool = False
+    # Seconds a file may take in total, and that any one stage (read, fingerprint, recognise) may take
+    file_timeout: Optional[float] = None
+    stage_timeout: Optional[float] = None
+
+
+@dataclass
+class RecognitionResult:
+    path: Path
+    status: Status
+    final_path: Optional[Path] = None
+    metadata: Dict[str, str] = field(default_factory=dict)
+    # Why the file was not tagged, if it was not
+    error: Optional[str] = None
+    attempts: int = 0
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.status in (Status.TAGGED, Status.ALREADY_TAGGED)
+
+    def to_dict(self) -> dict:
+        return {
+            "path": str(self.path),
+            "status": self.status.value,
+            "final_path": str(self.final_path) if self.final_path else None,
+            "metadata": self.metadata,
+            "error": self.error,
+            "attempts": self.attempts,
+            "timings": self.timings,
+        }
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+class _Deadline:
+    """Per-file and per-stage time budgets.
+
+    Budgets are checked as each stage starts and ends. Reading and fingerprinting run in a
+    _StageWorker that is killed if they overrun, and network requests are given no more time
+    than remains.
+    """
+
+    def __init__(self, file_timeout=None, stage_timeout=None):
+        self.file_timeout = file_timeout
+        self.stage_timeout = stage_timeout
+        self.expires = time.perf_counter() + file_timeout if file_timeout else math.inf
+
+    def remaining(self, timings=None, stage=None):
+        remaining = self.expires - time.perf_counter()
+        if stage is not None and self.stage_timeout:
+            remaining = min(remaining, self.stage_timeout - timings.get(stage, 0.0))
+        return remaining
+
+    def check(self, timings, stage):
+        if self.expires <= time.perf_counter():
+            raise _DeadlineExceeded(f"file exceeded its {self.file_timeout:g}s deadline during {stage}")
+        if self.stage_timeout and timings.get(stage, 0.0) >= self.stage_timeout:
+            raise _DeadlineExceeded(f"{stage} exceeded its {self.stage_timeout:g}s deadline")
+
+
+def _window_signatures(samples):
+    """All signatures of one recognition window, encoded so they can cross a process boundary."""
+    from recognition.algorithm import SignatureGenerator
+
+    signature_generator = SignatureGenerator()
+    signature_generator.MAX_TIME_SECONDS = RECOGNITION_WINDOW_SECONDS
+    signature_generator.feed_input(samples)
+    signatures = []
+    while True:
+        signature = signature_generator.get_next_signature()
+        if not signature:
+            return signatures
+        signatures.append(signature.encode_to_binary())
+
+
+def _stage_worker_main(conn):
+    import numpy as np
+    from audio import to_fingerprint_samples
+
+    # Pay the numpy/resampy/numba start-up before the first budgeted job
+    to_fingerprint_samples(np.zeros((4410, 1), dtype=np.float32), 44100)
+    _window_signatures(np.zeros(16000, dtype=np.int16))
+    conn.send((True, None))
+
+    while True:
         try:
-            resolved_path = filepath.resolve()
-        except OSError as exc:
-            print(f"Skipping {filepath.name}: could not resolve path ({exc})", file=sys.stderr)
-            continue
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (True, fn(*args))
+        except Exception as exc:
+            reply = (False, exc)
+        try:
+            conn.send(reply)
+        except Exception as exc:
+            conn.send((False, RuntimeError(str(reply[1]) if not reply[0] else str(exc))))
 
-        if not _is_within_directory(resolved_path, base_dir):
-            print(f"Skipping {filepath.name}: file is outside the target directory", file=sys.stderr)
-            continue
 
-        filepath = resolved_path
+class _StageWorker:
+    """A child process for the read and fingerprint stages, killed when a stage overruns its budget.
 
-        # Skip files that already have artist metadata not equal to 'Unknown'
+    A decode that hangs inside libsndfile cannot be interrupted in a thread, but a process can
+    be killed; a fresh one is started for the next file.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._conn = None
+
+    def start(self):
+        import multiprocessing
+
+        if self._process is not None and self._process.is_alive():
+            return
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_stage_worker_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
         try:
-            audio = MP3(filepath)
-            artist = None
-            if audio.tags is not None:
-                id3 = ID3(filepath)
-                if 'TPE1' in id3:
-                    artist = id3['TPE1'].text[0]
-            if artist and artist.strip().lower() != 'unknown':
-                print(f"Skipping {filepath.name}: artist metadata already set to '{artist}'")
-                continue
-        except Exception as e:
-            print(f"Warning: Could not read metadata from {filepath.name}: {e}", file=sys.stderr)
+            self._conn.recv()
+        except EOFError:
+            self.kill()
+            raise RuntimeError("stage worker process failed to start")
+
+    def call(self, deadline, timings, stage, fn, *args):
+        self.start()
+        self._conn.send((fn, args))
+        timeout = max(0.0, deadline.remaining(timings, stage))
+        if not self._conn.poll(None if timeout == math.inf else timeout):
+            self.kill()
+            raise _DeadlineExceeded(f"{stage} did not finish within its deadline and was cancelled")
+        try:
+            ok, value = self._conn.recv()
+        except EOFError:
+            self.kill()
+            raise RuntimeError(f"worker process died during {stage}")
+        if not ok:
+            raise value
+        return value
+
+    def kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+
+_stage_workers = threading.local()
+
+
+def _stage_worker():
+    # One per thread, so --jobs workers never wait on each other's child process
+    worker = getattr(_stage_workers, "worker", None)
+    if worker is None:
+        worker = _stage_workers.worker = _StageWorker()
+    worker.start()
+    return worker
+
+
+class _Timer:
+    def __init__(self, timings, stage, deadline=None):
+        self.timings = timings
+        self.stage = stage
+        self.deadline = deadline
+
+    def __enter__(self):
+        if self.deadline is not None:
+            self.deadline.check(self.timings, self.stage)
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + elapsed
+        if self.deadline is not None and exc_info[0] is None:
+            self.deadline.check(self.timings, self.stage)
+
+
+_rename_lock = threading.Lock()
+_pace_lock = threading.Lock()
+_last_paced_request = -math.inf
+
+
+def _pace(delay):
+    """Space files' first recognition requests at least delay seconds apart, across every thread in the process."""
+    global _last_paced_request
+
+    if delay <= 0:
+        return
+    with _pace_lock:
+        now = time.monotonic()
+        start = max(now, _last_paced_request + delay)
+        _last_paced_request = start
+    time.sleep(start - now)
+
+
+def _sanitize_filename(text, fallback):
+    unsafe = '\\/:*?"<>|'
+    cleaned = ''.join('-' if (c in unsafe or ord(c) < 32) else c for c in (text or fallback))
+    cleaned = cleaned.strip().lstrip('.')
+    return cleaned or fallback
+
+
+def _rename_to_metadata(filepath, metadata, overwrite):
+    artist = _sanitize_filename(metadata.get("artist", "Unknown Artist"), "Unknown Artist")
+    title = _sanitize_filename(metadata.get("title", "Unknown Title"), "Unknown Title")
+
+    ext = filepath.suffix or ".mp3"
+    base_name = f"{artist} - {title}"
+    max_filename_length = 128
+    max_base_length = max(1, max_filename_length - len(ext))
+    if len(base_name) > max_base_length:
+        base_name = base_name[:max_base_length].rstrip()
+
+    new_name = f"{base_name}{ext}"
+    new_path = filepath.with_name(new_name)
+
+    # Concurrent workers may resolve different files to the same name
+    with _rename_lock:
+        if new_path == filepath:
+            logger.info(f"File already has the correct name: {new_name}")
+            return filepath
+
+        if not overwrite:
+            # link() fails if the target exists, so this cannot clobber a file another host just renamed
+            try:
+                os.link(filepath, new_path)
+            except FileExistsError:
+                logger.warning(f"File {new_name} already exists, not renaming. Use --overwrite to replace existing files.")
+                return filepath
+            except OSError:
+                pass
+            else:
+                filepath.unlink()
+                return new_path
 
-        samples = load_audio(filepath)
-        time.sleep(args.delay)  # Sleep to avoid sending requests too quickly
+            if new_path.exists():
+                logger.warning(f"File {new_name} already exists, not renaming. Use --overwrite to replace existing files.")
+                return filepath
 
-        signature_generator = SignatureGenerator()
-        signature_generator.MAX_TIME_SECONDS = 12
-        duration_seconds = len(samples) / 16000
-
-        # Use a centered 12-second window on long files to skip lengthy intros/outros
-        if duration_seconds > 36:
-            start = max(0, int((duration_seconds / 2 - 6) * 16000))
-            end = start + 12 * 16000
-            samples_slice = samples[start:end]
-        else:
-            samples_slice = samples
+        filepath.replace(new_path)
+        return new_path
 
-        signature_generator.feed_input(samples_slice)
 
-        results = "(Not enough data)"
+def iter_signatures(filepath, window_starts, timings=None, deadline=None, worker=None):
+    """Yield (window start, signature) pairs for each window in turn, reading one window at a time.
 
-        backoff_base = max(args.delay, 0.5)
-        max_retries = 3
-        retry = 0
+    With a worker, reading and fingerprinting run in its process so they can be cancelled.
+    """
+    from recognition.algorithm import SignatureGenerator
+    from recognition.signature_format import DecodedMessage
+
+    timings = {} if timings is None else timings
+
+    for start_seconds in window_starts:
+        if worker is not None:
+            with _Timer(timings, "read", deadline):
+                samples = worker.call(deadline, timings, "read", read_recognition_window, filepath, start_seconds)
+            with _Timer(timings, "fingerprint", deadline):
+                encoded = worker.call(deadline, timings, "fingerprint", _window_signatures, samples)
+            for data in encoded:
+                yield start_seconds, DecodedMessage.decode_from_binary(data)
+            continue
+
+        with _Timer(timings, "read", deadline):
+            samples = read_recognition_window(filepath, start_seconds)
+
+        signature_generator = SignatureGenerator()
+        signature_generator.MAX_TIME_SECONDS = RECOGNITION_WINDOW_SECONDS
+        signature_generator.feed_input(samples)
 
         while True:
-            signature = signature_generator.get_next_signature()
+            with _Timer(timings, "fingerprint", deadline):
+                signature = signature_generator.get_next_signature()
             if not signature:
-                print(f"No signature generated for {filepath.stem}", file=sys.stderr)
                 break
+            yield start_seconds, signature
+
+
+def recognise_signatures(signatures, options, result, deadline=None):
+    """Send signatures until one matches and return Shazam's response.
+
+    Request errors resend the same signature with exponential backoff; a no-match moves on to
+    the next signature. Returns None, with result.status and result.error set, if nothing matched.
+    """
+    from recognition.communication import recognise_song_from_signature
+
+    label = result.path.stem
+    backoff_base = max(options.delay, 0.5)
+    retry = 0
+    signature = next(signatures, None)
+    if signature:
+        # Paced only once the first signature is ready, so reading and fingerprinting time does
+        # not eat into the gap; shared by all workers so --jobs does not multiply the request rate
+        _pace(options.delay)
+
+    while True:
+        if not signature:
+            result.status = Status.NO_MATCH
+            result.error = "no matching song found" if result.attempts else "no signature generated"
+            return None
+
+        timeout = 15
+        if deadline is not None:
+            # Checked only before sending: a match that arrives late is still used, not thrown away
+            deadline.check(result.timings, "recognise")
+            timeout = max(0.1, min(15, deadline.remaining(result.timings, "recognise")))
+        with _Timer(result.timings, "recognise"):
+            results = recognise_song_from_signature(signature, timeout=timeout)
+        result.attempts += 1
+
+        if results.get("error"):
+            retry += 1
+            if retry > options.max_retries:
+                result.status = Status.FAILED
+                result.error = f"recognition failed after {options.max_retries} retries: {results['error']}"
+                return None
+
+            backoff = max(backoff_base, backoff_base * (2 ** (retry - 1)))
+            if deadline is not None and backoff >= deadline.remaining():
+                raise _DeadlineExceeded(f"file deadline reached while retrying: {results['error']}")
+            logger.warning(f"Recognition error for {label}: {results['error']}. Retrying in {backoff:.2f}s...")
+            time.sleep(backoff)
+            # The signature itself was fine, so resend it rather than spending another window
+            continue
+
+        if results.get("matches"):
+            return results
+
+        logger.info(f"Note: No matching songs for {label} in this window, trying to recognise more input...")
+        signature = next(signatures, None)
+
+
+def tag_file(filepath, metadata, options, signature_tag=None):
+    """Write metadata and cover art to filepath, renaming it if requested; returns the final path.
+
+    signature_tag (from encode_signature_tag) is stored alongside when options.store_signature is set.
+    """
+    coverart_path = download_cover_art(metadata["coverarturl"], filepath)
+    try:
+        set_metadata(filepath, metadata, coverart_path, signature_tag if options.store_signature else None)
+    finally:
+        if coverart_path is not None:
+            coverart_path.unlink(missing_ok=True)
+
+    # Rename file to '<artist> - <title>.<ext>' if requested
+    if options.rename:
+        filepath = _rename_to_metadata(filepath, metadata, options.overwrite)
+    return filepath
+
+
+def _recognise_into(result, options):
+    filepath = result.path
+    # Started before the clock does, so spawning a replacement for a killed worker is not charged to the file
+    worker = _stage_worker() if options.file_timeout or options.stage_timeout else None
+    deadline = _Deadline(options.file_timeout, options.stage_timeout)
+
+    if filepath.is_symlink():
+        result.status, result.error = Status.SKIPPED, "symlinked files are not processed"
+        return
+
+    try:
+        resolved_path = filepath.resolve()
+    except OSError as exc:
+        result.status, result.error = Status.SKIPPED, f"could not resolve path ({exc})"
+        return
+
+    if options.base_dir is not None and not _is_within_directory(resolved_path, options.base_dir):
+        result.status, result.error = Status.SKIPPED, "file is outside the target directory"
+        return
+
+    filepath = resolved_path
+
+    reason = untaggable_reason(filepath)
+    if reason:
+        result.status, result.error = Status.SKIPPED, reason
+        return
+
+    # Skip files that already have artist metadata not equal to 'Unknown'
+    try:
+        artist, stored = read_tags(filepath)
+    except Exception as e:
+        logger.warning(f"Warning: Could not read metadata from {filepath.name}: {e}")
+        artist, stored = None, None
+    if artist and artist.strip().lower() != 'unknown':
+        result.status, result.error = Status.ALREADY_TAGGED, f"artist metadata already set to '{artist}'"
+        result.final_path = filepath
+        return
+
+    def windows():
+        # A signature kept from an earlier run is tried before any audio is decoded
+        if stored is not None:
+            yield stored
+        with _Timer(result.timings, "read", deadline):
+            if worker is None:
+                window_starts = plan_recognition_windows(filepath)
+            else:
+                window_starts = worker.call(deadline, result.timings, "read", plan_recognition_windows, filepath)
+        yield from iter_signatures(filepath, window_starts[:max(1, options.max_windows)], result.timings, deadline, worker)
+
+    matched = []
+
+    def signatures():
+        for window, signature in windows():
+            matched[:] = [(window, signature)]
+            yield signature
+
+    results = recognise_signatures(signatures(), options, result, deadline)
+    if results is None:
+        return
+
+    metadata = extract_metadata(results)
+    # Once a match is in hand the file is always tagged, however long that takes
+    with _Timer(result.timings, "tag"):
+        filepath = tag_file(filepath, metadata, options, encode_signature_tag(*matched[0]))
+
+    result.status = Status.TAGGED
+    result.metadata = metadata
+    result.final_path = filepath
+
+
+def recognise_file(path, options=None) -> RecognitionResult:
+    """Recognise and tag a single file without printing; failures are reported in the result, not raised."""
+    options = options or RecognitionOptions()
+    result = RecognitionResult(path=Path(path), status=Status.FAILED)
+    started = time.perf_counter()
+
+    try:
+        _recognise_into(result, options)
+    except _DeadlineExceeded as exc:
+        result.status = Status.TIMED_OUT
+        result.error = str(exc)
+    except Exception as exc:
+        result.status = Status.FAILED
+        result.error = str(exc) or type(exc).__name__
+
+    result.timings["total"] = time.perf_counter() - started
+    return result
+
+
+def estimate_cost(filepath):
+    """Rough relative cost of recognising filepath: its duration from the header, else its size."""
+    from audio import AudioSource
+
+    # Only the audio header is read; the tags are left for the one load in _recognise_into
+    try:
+        with AudioSource(filepath) as source:
+            duration = source.duration
+    except Exception:
+        duration = 0.0
+    if duration:
+        return duration
+    try:
+        # A header that cannot be read is treated as a 128 kbit/s file of the same size
+        return filepath.stat().st_size / 16000
+    except OSError:
+        return 0.0
+
+
+def order_by_cost(paths):
+    """Longest first, so the files that take longest start early instead of straggling at the end of a parallel run."""
+    return sorted(paths, key=lambda path: (-estimate_cost(path), str(path)))
+
+
+def recognise_many(paths, options=None, concurrency=4) -> Iterator[RecognitionResult]:
+    """Recognise files on a thread pool, yielding each result as soon as it finishes."""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    options = options or RecognitionOptions()
+    paths = iter(paths)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Keep a bounded number of files in flight so huge or lazy inputs are not expanded up front
+        pending = {executor.submit(recognise_file, path, options) for path in islice(paths, concurrency * 2)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                for path in islice(paths, 1):
+                    pending.add(executor.submit(recognise_file, path, options))
+
+
+def _report(result):
+    name = result.path.name
+    if result.status is Status.TAGGED:
+        if result.final_path != result.path.resolve():
+            print(f"Renamed file to {result.final_path.name}")
+        print(f"Finished writing metadata for {result.final_path.name}")
+    elif result.status is Status.ALREADY_TAGGED:
+        print(f"Skipping {name}: {result.error}")
+    elif result.status is Status.SKIPPED:
+        print(f"Skipping {name}: {result.error}", file=sys.stderr)
+    else:
+        print(f"Could not tag {name}: {result.error}", file=sys.stderr)
+
+
+def watch_directory(base_dir, options, args):
+    from watch import DirectoryWatcher
+
+    watcher = DirectoryWatcher(base_dir, settle_seconds=args.settle, use_inotify=not args.poll)
+    mode = "inotify" if watcher.uses_inotify else "polling"
+    print(f"Watching {base_dir} for new files ({mode}), press Ctrl+C to stop")
+
+    def handle(filepath):
+        result = recognise_file(filepath, options)
+        _report(result)
+        watcher.mark_seen(filepath)
+        if result.final_path is not None:
+            watcher.mark_seen(result.final_path)
+
+    try:
+        # Catch up on anything in the tree that landed while we were not running; the skip check makes this cheap
+        for filepath in watcher.existing_files():
+            handle(filepath)
+
+        for filepath in watcher:
+            handle(filepath)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
 
-            results = recognise_song_from_signature(signature)
 
-            if results.get("error"):
-                retry += 1
-                if retry > max_retries:
-                    print(f"Recognition failed for {filepath.stem} after {max_retries} retries: {results['error']}", file=sys.stderr)
-                    break
+def _claim_loop(queue, base_dir, options, stop, changed):
+    from workqueue import Heartbeat
 
-                backoff = max(backoff_base, backoff_base * (2 ** (retry - 1)))
-                print(f"Recognition error for {filepath.stem}: {results['error']}. Retrying in {backoff:.2f}s...", file=sys.stderr)
-                time.sleep(backoff)
+    try:
+        while not stop.is_set():
+            lease = queue.claim()
+            if lease is None:
+                # Wait for leases held by other hosts (or threads) so files from a dead host are still retried
+                expiry = queue.next_lease_expiry()
+                if expiry is None:
+                    return
+                changed.wait(min(max(expiry - time.time(), 1.0), 30.0))
+                changed.clear()
                 continue
 
-            if results.get("matches"):
-                metadata = extract_metadata(results)
-                coverart_path = download_cover_art(metadata["coverarturl"], filepath)
-                set_mp3_metadata(filepath, metadata, coverart_path)
-                
-                # Rename file to '<artist> - <title>.mp3' if --rename flag is set
-                if args.rename:
-                    unsafe = '\\/:*?"<>|'
-
-                    def sanitize(text, fallback):
-                        cleaned = ''.join('-' if (c in unsafe or ord(c) < 32) else c for c in (text or fallback))
-                        cleaned = cleaned.strip().lstrip('.')
-                        return cleaned or fallback
-
-                    artist = sanitize(metadata.get("artist", "Unknown Artist"), "Unknown Artist")
-                    title = sanitize(metadata.get("title", "Unknown Title"), "Unknown Title")
-
-                    ext = filepath.suffix or ".mp3"
-                    base_name = f"{artist} - {title}"
-                    max_filename_length = 128
-                    max_base_length = max(1, max_filename_length - len(ext))
-                    if len(base_name) > max_base_length:
-                        base_name = base_name[:max_base_length].rstrip()
-
-                    new_name = f"{base_name}{ext}"
-                    new_path = filepath.with_name(new_name)
-
-                    if new_path.exists() and new_path != filepath:
-                        if args.overwrite:
-                            new_path.unlink()
-                        else:
-                            print(f"File {new_name} already exists, not renaming. Use --overwrite to replace existing files.", file=sys.stderr)
-                            print(f"Finished writing metadata for {filepath.stem}.mp3")
-                            break
-
-                    if new_path != filepath:
-                        filepath.rename(new_path)
-                        filepath = new_path
-                        print(f"Renamed file to {new_name}")
-                    else:
-                        print(f"File already has the correct name: {new_name}")
-                
-                print(f"Finished writing metadata for {filepath.stem}.mp3")
-                break
+            with Heartbeat(queue, lease) as heartbeat:
+                result = recognise_file(base_dir / lease.path, options)
+            _report(result)
+
+            if heartbeat.lost:
+                print(f"Lease on {lease.path} was lost to another worker; leaving its state alone", file=sys.stderr)
+            elif result.status in (Status.FAILED, Status.TIMED_OUT):
+                queue.release(lease, result.error)
             else:
-                print(
-                    f"Note: No matching songs for {filepath.stem} the first {signature_generator.samples_processed / 16000:.3f} seconds, trying to recognise more input...",
-                    file=sys.stderr
-                )
+                final_path = result.final_path.relative_to(base_dir).as_posix() if result.final_path else None
+                queue.complete(lease, result.status.value, result.error, final_path)
+            changed.set()
+    finally:
+        changed.set()
+
+
+def process_queue(base_dir, audio_files, options, args):
+    from concurrent.futures import ThreadPoolExecutor
+    from workqueue import WorkQueue
+
+    queue = WorkQueue(args.queue, lease_seconds=args.lease)
+    queues = [queue]
+    try:
+        relative_paths = []
+        for path in audio_files:
+            # --files-from lists may hold absolute paths (a --retry-list always does)
+            try:
+                relative_paths.append(path.resolve().relative_to(base_dir).as_posix())
+            except (OSError, ValueError):
+                print(f"Skipping {path}: outside the target directory", file=sys.stderr)
+        added = queue.enqueue(relative_paths)
+        print(f"Queued {added} new files in {args.queue}")
+
+        # Each claim loop gets its own connection and owner id, so a lease one thread lets lapse
+        # is still seen as lost if a sibling thread claims the file again
+        queues += [WorkQueue(args.queue, lease_seconds=args.lease, worker_id=f"{queue.worker_id}/{index}")
+                   for index in range(1, max(1, args.jobs))]
+        stop = threading.Event()
+        changed = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(queues), thread_name_prefix="queue") as executor:
+            futures = [executor.submit(_claim_loop, worker_queue, base_dir, options, stop, changed)
+                       for worker_queue in queues]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Let the other loops finish the file in hand and stop claiming
+                stop.set()
+                changed.set()
+                raise
+
+        counts = queue.counts()
+        print(", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+    finally:
+        for worker_queue in queues:
+            worker_queue.close()
+
+
+def main():
+    parser = ArgumentParser(
+        prog="metaaudio",
+        description="Generate a Shazam fingerprint from a sound file, perform song recognition towards Shazam's servers and append the metadata to the audio file (.MP3, .FLAC, .WAV and .AIFF are supported)"
+    )
+    parser.add_argument("input_dir", help="The directory containing music files to recognise")
+    parser.add_argument("--rename", action="store_true", help="Rename music files to '<artist> - <title>.<ext>' format")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files when renaming (requires --rename)")
+    parser.add_argument("--delay", type=float, default=0, help="Minimum seconds between files' recognition requests, shared by all --jobs (default: 0)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of files to recognise concurrently (default: 1)")
+    parser.add_argument("--hedge", type=float, metavar="PERCENTILE", help="Send a duplicate of any recognition request slower than this percentile of recent ones (e.g. 95)")
+    parser.add_argument("--hedge-rate", type=float, default=0.1, help="Most duplicate requests --hedge may send, as a fraction of all requests (default: 0.1)")
+    parser.add_argument("--queue", help="Share the directory with other hosts through this SQLite work queue (on the shared volume)")
+    parser.add_argument("--lease", type=float, default=600, help="Seconds a --queue worker holds a file before another host may retry it (default: 600)")
+    parser.add_argument("--file-timeout", type=float, help="Give up on a file after this many seconds and list it for a retry")
+    parser.add_argument("--stage-timeout", type=float, help="Give up on a file once reading, fingerprinting or recognising it takes this many seconds")
+    parser.add_argument("--retry-list", help="Append files that timed out to this file, one path per line")
+    parser.add_argument("--files-from", help="Process the files listed in this file (e.g. a --retry-list) instead of the whole directory")
+    parser.add_argument("--io-mode", choices=["ssd", "hdd", "nfs"], help="Order reads and read ahead for the storage the library is on: hdd visits files in disk order, nfs keeps many reads in flight")
+    parser.add_argument("--prefetch", type=int, help="Files to read ahead in --io-mode (default: 2 for hdd, 8 for nfs)")
+    parser.add_argument("--store-signature", action="store_true", help="Store the matching fingerprint in each tagged file so later runs can reuse it without decoding")
+    parser.add_argument("--watch", action="store_true", help="Keep running and tag new files as they land in the directory tree")
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds a new file must stay unchanged before it is processed in --watch mode (default: 2)")
+    parser.add_argument("--poll", action="store_true", help="Poll the directory tree instead of using inotify in --watch mode")
+    args = parser.parse_args()
+
+    if args.overwrite and not args.rename:
+        print("--overwrite requires --rename; please specify both or remove --overwrite.", file=sys.stderr)
+        sys.exit(1)
+    if args.jobs < 1:
+        print("--jobs must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+    if args.hedge is not None and not (0 < args.hedge < 100 and 0 <= args.hedge_rate <= 1):
+        print("--hedge must be between 0 and 100 and --hedge-rate between 0 and 1.", file=sys.stderr)
+        sys.exit(1)
+    if (args.file_timeout is not None and args.file_timeout <= 0) or (args.stage_timeout is not None and args.stage_timeout <= 0):
+        print("--file-timeout and --stage-timeout must be positive.", file=sys.stderr)
+        sys.exit(1)
+    if args.prefetch is not None and (args.prefetch < 0 or not args.io_mode):
+        print("--prefetch requires --io-mode and cannot be negative.", file=sys.stderr)
+        sys.exit(1)
+    input_dir = Path(args.input_dir)
+
+    if not input_dir.is_dir():
+        print(f"Directory not found: {input_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.files_from:
+        try:
+            listed = [Path(line.strip()) for line in Path(args.files_from).read_text(encoding="utf-8").splitlines() if line.strip()]
+        except OSError as exc:
+            print(f"Could not read {args.files_from}: {exc}", file=sys.stderr)
+            sys.exit(1)
+        audio_files = []
+        for path in listed:
+            path = path if path.is_absolute() else input_dir / path
+            if path.suffix.lower() not in SUPPORTED_FORMATS:
+                continue
+            if not path.is_file():
+                print(f"Skipping {path}: file not found", file=sys.stderr)
+                continue
+            audio_files.append(path)
+    elif args.io_mode:
+        from storage import STORAGE_PROFILES, scan_directory, order_for_storage
+
+        # Directory entries carry inode numbers, so ordering needs no stat per file
+        entries = [entry for entry in scan_directory(input_dir) if entry[0].suffix.lower() in SUPPORTED_FORMATS]
+        audio_files = order_for_storage(entries, STORAGE_PROFILES[args.io_mode].order)
+    else:
+        audio_files = [path for path in input_dir.glob("*") if path.suffix.lower() in SUPPORTED_FORMATS]
+
+    if not audio_files and not args.watch:
+        print("No supported music files found in the specified directory.", file=sys.stderr)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.hedge is not None:
+        from recognition.communication import configure_hedging
+
+        configure_hedging(args.hedge, args.hedge_rate)
+
+    base_dir = input_dir.resolve()
+    options = RecognitionOptions(
+        rename=args.rename, overwrite=args.overwrite, delay=args.delay, base_dir=base_dir,
+        store_signature=args.store_signature, file_timeout=args.file_timeout, stage_timeout=args.stage_timeout,
+    )
+
+    if args.watch:
+        watch_directory(base_dir, options, args)
+        return
+
+    if args.queue:
+        process_queue(base_dir, audio_files, options, args)
+        return
+
+    if args.io_mode:
+        from storage import STORAGE_PROFILES, prefetch
+
+        profile = STORAGE_PROFILES[args.io_mode]
+        if args.jobs > 1 and profile.order is None:
+            audio_files = order_by_cost(audio_files)
+        # Disk order is kept even with --jobs: on slow storage locality matters more than stragglers
+        audio_files = prefetch(audio_files, profile.prefetch_files if args.prefetch is None else args.prefetch, profile.prefetch_bytes)
+    elif args.jobs > 1:
+        audio_files = order_by_cost(audio_files)
+
+    if args.jobs > 1:
+        results = recognise_many(audio_files, options, concurrency=args.jobs)
+    else:
+        results = (recognise_file(filepath, options) for filepath in audio_files)
+
+    timed_out = []
+    for result in results:
+        _report(result)
+        if result.status is Status.TIMED_OUT:
+            timed_out.append(result.path)
+
+    if timed_out:
+        if args.retry_list:
+            with open(args.retry_list, "a", encoding="utf-8") as handle:
+                handle.writelines(f"{path.resolve()}\n" for path in timed_out)
+            print(f"{len(timed_out)} files timed out; listed in {args.retry_list} for a retry with --files-from", file=sys.stderr)
+        else:
+            print(f"{len(timed_out)} files timed out", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,24 +2,137 @@
 
 from uuid import uuid5, getnode, NAMESPACE_DNS, NAMESPACE_URL
 from random import random, choice
-from zoneinfo import available_timezones
-from requests import post, RequestException
-from time import time
+from functools import lru_cache
+from collections import deque
+from threading import Lock
+from time import time, perf_counter
+from typing import List, Optional, Tuple
 from recognition.signature_format import DecodedMessage
 from recognition.user_agent import USER_AGENTS
 
 _locale = 'en-US'
-_first_uuid = str(uuid5(NAMESPACE_DNS, str(getnode()))).upper()
-_second_uuid = str(uuid5(NAMESPACE_URL, str(getnode())))
-_timezones = [tz for tz in available_timezones() if tz.startswith('Europe/')]
-if not _timezones:
-    _timezones = ['UTC']
+
+
+# Both lookups are deferred to the first request: getnode() may shell out and
+# available_timezones() walks the whole tz database, neither of which a bare import should pay for
+@lru_cache(maxsize=None)
+def _device_uuids() -> Tuple[str, str]:
+    node = str(getnode())
+    return str(uuid5(NAMESPACE_DNS, node)).upper(), str(uuid5(NAMESPACE_URL, node))
+
+
+@lru_cache(maxsize=None)
+def _session():
+    from requests import Session
+
+    # One pooled session per process keeps the TLS connection to Shazam warm between files
+    return Session()
+
+
+@lru_cache(maxsize=None)
+def _timezones() -> List[str]:
+    from zoneinfo import available_timezones
+
+    timezones = sorted(tz for tz in available_timezones() if tz.startswith('Europe/'))
+    return timezones or ['UTC']
 
 
 def _clamp(value: float, min_value: float, max_value: float) -> float:
     return max(min_value, min(max_value, value))
 
-def recognise_song_from_signature(signature: DecodedMessage) -> dict:
+
+class _Hedging:
+    """Latency history and hedge budget shared by every recognition request in the process."""
+
+    def __init__(self, percentile: float, max_hedge_ratio: float, history: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=history)
+        self._requests = 0
+        self._hedges = 0
+        self._lock = Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def delay(self) -> Optional[float]:
+        """Seconds to wait on a request before hedging it, or None until enough latencies are known."""
+        with self._lock:
+            self._requests += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def try_hedge(self) -> bool:
+        # Duplicates stay within max_hedge_ratio of all requests so hedging cannot multiply the request rate
+        with self._lock:
+            if self._hedges + 1 > self._requests * self.max_hedge_ratio:
+                return False
+            self._hedges += 1
+            return True
+
+
+_hedging: Optional[_Hedging] = None
+
+
+def configure_hedging(percentile: Optional[float] = 95.0, max_hedge_ratio: float = 0.1):
+    """Send a duplicate of any request slower than `percentile` of recent ones and use the first valid reply.
+
+    At most max_hedge_ratio extra requests are sent per request. Pass percentile=None to turn hedging off.
+    """
+    global _hedging
+    _hedging = None if percentile is None else _Hedging(percentile, max_hedge_ratio)
+
+
+@lru_cache(maxsize=None)
+def _hedge_pool():
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Requests that lose a race are left to finish in the background, so allow for a few of those
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix='recognition')
+
+
+def recognise_song_from_signature(signature: DecodedMessage, timeout: float = 15) -> dict:
+    hedging = _hedging
+    if hedging is None:
+        return _post_signature(signature, timeout)
+
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    def timed(request_timeout):
+        started = perf_counter()
+        results = _post_signature(signature, request_timeout)
+        if not results.get('error'):
+            hedging.record(perf_counter() - started)
+        return results
+
+    delay = hedging.delay()
+    if delay is None or delay >= timeout:
+        return timed(timeout)
+
+    pending = {_hedge_pool().submit(timed, timeout)}
+    done, _ = wait(pending, timeout=delay)
+    # The duplicate only gets what is left of the original's timeout, so hedging never extends the call
+    if not done and hedging.try_hedge():
+        pending.add(_hedge_pool().submit(timed, timeout - delay))
+
+    results = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results = future.result()
+            if not results.get('error'):
+                return results
+    return results
+
+
+def _post_signature(signature: DecodedMessage, timeout: float) -> dict:
+    from requests import RequestException
+
+    first_uuid, second_uuid = _device_uuids()
     fuzz = random() * 15.3 - 7.65
 
     altitude = random() * 400 + 100 + fuzz
@@ -28,8 +141,8 @@ def recognise_song_from_signature(signature: DecodedMessage) -> dict:
     timestamp_ms = int(time() * 1000)
 
     try:
-        response = post(
-            f'https://amp.shazam.com/discovery/v5/en/US/android/-/tag/{_first_uuid}/{_second_uuid}',
+        response = _session().post(
+            f'https://amp.shazam.com/discovery/v5/en/US/android/-/tag/{first_uuid}/{second_uuid}',
             params={
                 'sync': 'true',
                 'webv3': 'true',
@@ -56,9 +169,9 @@ def recognise_song_from_signature(signature: DecodedMessage) -> dict:
                     "uri": signature.encode_to_uri()
                 },
                 "timestamp": timestamp_ms,
-                "timezone": choice(_timezones)
+                "timezone": choice(_timezones())
             },
-            timeout=15
+            timeout=timeout
         )
         response.raise_for_status()
         return response.json()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from recognition.algorithm import SignatureGenerator
+from recognition.signature_format import DecodedMessage, FrequencyBand, FrequencyPeak
+
+SAMPLES_PER_FRAME = 128
+
+# A frame's peaks depend on the last 2048 samples (16 frames) and on spread FFT history
+# reaching back at most 91 frames, and are only emitted 46 frames later. Replaying the
+# full 256-frame ring plus one sample window before a segment reproduces the sequential
+# generator's state exactly.
+WARMUP_FRAMES = 256 + 16
+EMIT_DELAY_FRAMES = 46
+
+
+def _segment_peaks(samples: np.ndarray, first_frame: int, start_frame: int, end_frame: int) -> Dict[FrequencyBand, List[FrequencyPeak]]:
+    """Peaks for frames [start_frame, end_frame) from samples that begin at first_frame."""
+    signature_generator = SignatureGenerator()
+    signature_generator.MAX_TIME_SECONDS = float("inf")
+    signature_generator.feed_input(samples)
+    signature = signature_generator.get_next_signature()
+
+    peaks = {}
+    if signature is None:
+        return peaks
+
+    for band, band_peaks in signature.frequency_band_to_sound_peaks.items():
+        kept = []
+        for peak in band_peaks:
+            fft_pass_number = peak.fft_pass_number + first_frame
+            if start_frame <= fft_pass_number < end_frame:
+                peak.fft_pass_number = fft_pass_number
+                kept.append(peak)
+        if kept:
+            peaks[band] = kept
+    return peaks
+
+
+def _read_segment_peaks(read_segment: Callable[[int, int], np.ndarray], first_frame: int, start_frame: int,
+                       end_frame: int, last_frame: int) -> Dict[FrequencyBand, List[FrequencyPeak]]:
+    samples = read_segment(first_frame * SAMPLES_PER_FRAME, last_frame * SAMPLES_PER_FRAME)
+    return _segment_peaks(np.asarray(samples, dtype=np.int16), first_frame, start_frame, end_frame)
+
+
+def _plan_segments(total_frames: int, segment_seconds: float) -> List[Tuple[int, int, int, int]]:
+    """(first_frame, start_frame, end_frame, last_frame) for each segment, including its warm-up and emit delay."""
+    segment_frames = max(WARMUP_FRAMES, int(segment_seconds * 16000) // SAMPLES_PER_FRAME)
+    segments = []
+    for start_frame in range(0, total_frames, segment_frames):
+        end_frame = min(total_frames, start_frame + segment_frames)
+        first_frame = max(0, start_frame - WARMUP_FRAMES)
+        last_frame = min(total_frames, end_frame + EMIT_DELAY_FRAMES)
+        segments.append((first_frame, start_frame, end_frame, last_frame))
+    return segments
+
+
+def _map_segments(fn, jobs, executor: Optional[Executor], workers: Optional[int]):
+    own_executor = executor is None and len(jobs) > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+
+    try:
+        if executor is None:
+            return [fn(*job) for job in jobs]
+        return list(executor.map(fn, *zip(*jobs)))
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def _stitch(total_frames: int, segment_results) -> DecodedMessage:
+    signature = DecodedMessage()
+    signature.sample_rate_hz = 16000
+    signature.number_samples = total_frames * SAMPLES_PER_FRAME
+    signature.frequency_band_to_sound_peaks = {}
+    for peaks in segment_results:
+        for band, band_peaks in peaks.items():
+            signature.frequency_band_to_sound_peaks.setdefault(band, []).extend(band_peaks)
+    return signature
+
+
+def generate_full_signature(samples, executor: Optional[Executor] = None, workers: Optional[int] = None,
+                            segment_seconds: float = 60.0) -> Optional[DecodedMessage]:
+    """Fingerprint all of samples as one signature, splitting the work into segments.
+
+    Each segment is fed to its own SignatureGenerator starting WARMUP_FRAMES early and running
+    EMIT_DELAY_FRAMES past its end; only the peaks belonging to the segment are kept, with
+    fft_pass_number shifted back to whole-file positions. The stitched result is identical to
+    feeding everything to a single generator with no time limit.
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    total_frames = len(samples) // SAMPLES_PER_FRAME
+    if total_frames == 0:
+        return None
+
+    jobs = [(samples[first_frame * SAMPLES_PER_FRAME:last_frame * SAMPLES_PER_FRAME], first_frame, start_frame, end_frame)
+            for first_frame, start_frame, end_frame, last_frame in _plan_segments(total_frames, segment_seconds)]
+    return _stitch(total_frames, _map_segments(_segment_peaks, jobs, executor, workers))
+
+
+def generate_segmented_signature(read_segment: Callable[[int, int], np.ndarray], total_samples: int,
+                                 executor: Optional[Executor] = None, workers: Optional[int] = None,
+                                 segment_seconds: float = 60.0) -> Optional[DecodedMessage]:
+    """Like generate_full_signature, but each worker reads its own segment instead of being sent it.
+
+    read_segment(start, stop) returns 16 kHz int16 samples [start, stop) of a stream total_samples
+    long, the same samples whichever range they are read as part of, and must be picklable to run
+    in a process pool. The result equals generate_full_signature(read_segment(0, total_samples)),
+    but nothing is decoded in the caller, so memory stays at a few segments however long the stream is.
+    """
+    total_frames = total_samples // SAMPLES_PER_FRAME
+    if total_frames == 0:
+        return None
+
+    jobs = [(read_segment,) + segment for segment in _plan_segments(total_frames, segment_seconds)]
+    return _stitch(total_frames, _map_segments(_read_segment_peaks, jobs, executor, workers))
@@ -0,0 +1,57 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from audio import AudioSource, read_fingerprint_range
+from recognition.algorithm import SignatureGenerator
+from recognition.parallel import generate_full_signature, generate_segmented_signature
+
+soundfile = pytest.importorskip("soundfile")
+
+
+def _sequential_signature(samples):
+    signature_generator = SignatureGenerator()
+    signature_generator.MAX_TIME_SECONDS = float("inf")
+    signature_generator.feed_input(samples)
+    return signature_generator.get_next_signature()
+
+
+def _write_noise(path, samplerate, seconds, channels=2):
+    rng = np.random.default_rng(0)
+    soundfile.write(path, rng.standard_normal((int(samplerate * seconds), channels)) * 0.3, samplerate)
+    return str(path)
+
+
+@pytest.mark.parametrize("samplerate, suffix", [(44100, "wav"), (48000, "flac"), (16000, "wav")])
+def test_segmented_signature_matches_sequential(tmp_path, samplerate, suffix):
+    filepath = _write_noise(tmp_path / f"noise.{suffix}", samplerate, 25)
+    with AudioSource(filepath) as source:
+        total_samples = source.fingerprint_length
+        samples = source.fingerprint_range(0, total_samples)
+
+    sequential = _sequential_signature(samples)
+    parallel = generate_segmented_signature(partial(read_fingerprint_range, filepath), total_samples,
+                                            workers=2, segment_seconds=4)
+
+    assert parallel.encode_to_binary() == sequential.encode_to_binary()
+
+
+def test_full_signature_matches_sequential(tmp_path):
+    with AudioSource(_write_noise(tmp_path / "noise.wav", 44100, 25)) as source:
+        samples = source.fingerprint_range(0, source.fingerprint_length)
+
+    parallel = generate_full_signature(samples, workers=2, segment_seconds=4)
+
+    assert parallel.encode_to_binary() == _sequential_signature(samples).encode_to_binary()
+
+
+def test_fingerprint_ranges_concatenate_to_whole_file(tmp_path):
+    with AudioSource(_write_noise(tmp_path / "noise.wav", 44100, 25, channels=1)) as source:
+        total_samples = source.fingerprint_length
+        whole = source.fingerprint_range(0, total_samples)
+        cuts = [0, 1, 12345, 160000, 160001, 333333, total_samples]
+        pieces = [source.fingerprint_range(start, stop) for start, stop in zip(cuts, cuts[1:])]
+
+    assert len(whole) == total_samples
+    np.testing.assert_array_equal(np.concatenate(pieces), whole)
@@ -10,9 +10,7 @@ from mutagen.flac import FLAC
 from mutagen.wave import WAVE
 from mutagen.aiff import AIFF
 from mutagen import MutagenError
-from utils import _is_within_directory
-
-SUPPORTED_FORMATS = {'.mp3', '.flac', '.wav', '.aiff'}
+from utils import _is_within_directory, SUPPORTED_FORMATS
 
 def remove_metadata(filepath, file_ext):
     try:
@@ -55,42 +53,53 @@ def remove_metadata(filepath, file_ext):
     except (ID3NoHeaderError, MutagenError) as e:
         print(f"Error removing metadata from {filepath}: {e}")
 
-def process_directory(directory):
+def process_directory(directory, io_mode=None):
     base_dir = Path(directory).resolve()
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            filepath = Path(root) / file
+    if io_mode:
+        from storage import STORAGE_PROFILES, scan_directory, order_for_storage, prefetch
+
+        # Removing a tag can rewrite the whole file, so files are visited in disk order and read ahead
+        profile = STORAGE_PROFILES[io_mode]
+        filepaths = prefetch(
+            order_for_storage(scan_directory(directory, recursive=True), profile.order),
+            profile.prefetch_files, profile.prefetch_bytes,
+            select=lambda path: path.suffix.lower() in SUPPORTED_FORMATS,
+        )
+    else:
+        filepaths = (Path(root) / file for root, _, files in os.walk(directory) for file in files)
 
-            if filepath.is_symlink():
-                sys.stderr.write(f"Skipping symlinked file: {filepath}\n")
-                continue
+    for filepath in filepaths:
+        if filepath.is_symlink():
+            sys.stderr.write(f"Skipping symlinked file: {filepath}\n")
+            continue
 
-            try:
-                resolved_path = filepath.resolve()
-            except OSError as exc:
-                sys.stderr.write(f"Skipping file with unresolved path: {filepath} ({exc})\n")
-                continue
+        try:
+            resolved_path = filepath.resolve()
+        except OSError as exc:
+            sys.stderr.write(f"Skipping file with unresolved path: {filepath} ({exc})\n")
+            continue
 
-            file_ext = resolved_path.suffix.lower()
+        file_ext = resolved_path.suffix.lower()
 
-            if not _is_within_directory(resolved_path, base_dir):
-                sys.stderr.write(f"Skipping file outside target directory: {filepath}\n")
-                continue
+        if not _is_within_directory(resolved_path, base_dir):
+            sys.stderr.write(f"Skipping file outside target directory: {filepath}\n")
+            continue
 
-            if file_ext in SUPPORTED_FORMATS:
-                remove_metadata(str(resolved_path), file_ext)
-            else:
-                print(f"Skipped unsupported file: {filepath}")  # Optional if you want to see skipped files
+        if file_ext in SUPPORTED_FORMATS:
+            remove_metadata(str(resolved_path), file_ext)
+        else:
+            print(f"Skipped unsupported file: {filepath}")  # Optional if you want to see skipped files
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Remove metadata from all music files in a directory (.MP3, .FLAC, .WAV and .AIFF are supported)"
     )
     parser.add_argument("input_dir", help="The directory containing music files to process")
+    parser.add_argument("--io-mode", choices=["ssd", "hdd", "nfs"], help="Order reads and read ahead for the storage the library is on")
     args = parser.parse_args()
 
     if os.path.isdir(args.input_dir):
-        process_directory(args.input_dir)
+        process_directory(args.input_dir, args.io_mode)
     else:
         sys.stderr.write(f"Directory not found: {args.input_dir}\n")
\ No newline at end of file
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import tempfile
+import threading
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from utils import _is_within_directory, SUPPORTED_FORMATS
+
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+
+
+def _warm_worker():
+    # Pay the numpy/resampy/numba start-up once per worker rather than on its first request
+    import numpy as np
+    from audio import to_fingerprint_samples
+    import recognition.algorithm  # noqa: F401
+
+    to_fingerprint_samples(np.zeros((4410, 1), dtype=np.float32), 44100)
+
+
+def _fingerprint_job(filepath):
+    from metaaudio import plan_recognition_windows, read_recognition_window, RECOGNITION_WINDOW_SECONDS
+    from recognition.algorithm import SignatureGenerator
+
+    start_seconds = plan_recognition_windows(filepath)[0]
+    signature_generator = SignatureGenerator()
+    signature_generator.MAX_TIME_SECONDS = RECOGNITION_WINDOW_SECONDS
+    signature_generator.feed_input(read_recognition_window(filepath, start_seconds))
+    signature = signature_generator.get_next_signature()
+    if not signature:
+        return None
+    return {
+        "uri": signature.encode_to_uri(),
+        "samplems": int(signature.number_samples / signature.sample_rate_hz * 1000),
+    }
+
+
+def _recognise_job(uri):
+    from metaaudio import extract_metadata
+    from recognition.communication import recognise_song_from_signature
+    from recognition.signature_format import DecodedMessage
+
+    results = recognise_song_from_signature(DecodedMessage.decode_from_uri(uri))
+    response = {"results": results}
+    if results.get("matches"):
+        response["metadata"] = extract_metadata(results)
+    return response
+
+
+def _tag_job(filepath, options):
+    from metaaudio import recognise_file
+
+    return recognise_file(filepath, options).to_dict()
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class RecognitionService:
+    """Runs jobs on warm worker pools behind a bounded queue.
+
+    Fingerprinting and tagging are CPU-bound and go to a process pool; recognising an
+    existing signature only waits on the network and runs on a thread pool. Once
+    workers + queue_size jobs are in flight, new requests are rejected instead of queued.
+    """
+
+    def __init__(self, base_dir, options, workers=2, queue_size=16):
+        self.base_dir = base_dir
+        self.options = options
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._cpu_pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker)
+        self._io_pool = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    def acquire(self):
+        """Take a slot for one job, or reject the request before any of its body is read."""
+        if not self._slots.acquire(blocking=False):
+            raise _HTTPError(503, "server busy, retry later", {"Retry-After": "1"})
+        with self._lock:
+            self._in_flight += 1
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def run(self, pool, fn, *fn_args):
+        """Run fn on a pool; the caller must hold a slot from acquire()."""
+        pool = self._cpu_pool if pool == "cpu" else self._io_pool
+        return pool.submit(fn, *fn_args).result()
+
+    def resolve_library_path(self, raw_path):
+        filepath = Path(raw_path)
+        if not filepath.is_absolute():
+            filepath = self.base_dir / filepath
+        if filepath.is_symlink():
+            raise _HTTPError(403, "symlinked files are not processed")
+        if not _is_within_directory(filepath, self.base_dir):
+            raise _HTTPError(403, "file is outside the library directory")
+        if filepath.suffix.lower() not in SUPPORTED_FORMATS:
+            raise _HTTPError(400, f"unsupported file type '{filepath.suffix}'")
+        if not filepath.is_file():
+            raise _HTTPError(404, "file not found")
+        return filepath.resolve()
+
+    def shutdown(self):
+        self._cpu_pool.shutdown(cancel_futures=True)
+        self._io_pool.shutdown(cancel_futures=True)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    service = None
+    protocol_version = "HTTP/1.1"
+    _holding_slot = False
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _content_length(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise _HTTPError(411, "Content-Length is required")
+        try:
+            length = int(length)
+        except ValueError:
+            raise _HTTPError(400, "invalid Content-Length")
+        if length < 0 or length > MAX_UPLOAD_BYTES:
+            raise _HTTPError(413, f"request body exceeds {MAX_UPLOAD_BYTES} bytes")
+        return length
+
+    def _read_json(self):
+        try:
+            payload = json.loads(self.rfile.read(self._content_length()) or b"{}")
+        except ValueError:
+            raise _HTTPError(400, "request body is not valid JSON")
+        if not isinstance(payload, dict):
+            raise _HTTPError(400, "request body must be a JSON object")
+        return payload
+
+    def _post_handler(self):
+        return {
+            "/fingerprint": self._handle_fingerprint,
+            "/recognise": self._handle_recognise,
+            "/tag": self._handle_tag,
+        }.get(urlparse(self.path).path)
+
+    def handle_expect_100(self):
+        # Answer "Expect: 100-continue" with 503 rather than inviting a body there is no room for.
+        # Only requests that will run a job take a slot; the rest get their 404 or 501 as usual
+        if self.command != "POST" or self._post_handler() is None:
+            return super().handle_expect_100()
+        try:
+            self.service.acquire()
+        except _HTTPError as exc:
+            self.close_connection = True
+            self._send_json(exc.status, {"error": str(exc)}, exc.headers)
+            return False
+        self._holding_slot = True
+        return super().handle_expect_100()
+
+    def _release_slot(self):
+        if self._holding_slot:
+            self._holding_slot = False
+            self.service.release()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            # Whatever happened to the request, a slot taken for it is never kept past it
+            self._release_slot()
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {
+            "status": "ok",
+            "workers": self.service.workers,
+            "in_flight": self.service.in_flight,
+            "capacity": self.service.capacity,
+        })
+
+    def do_POST(self):
+        handler = self._post_handler()
+
+        try:
+            if handler is None:
+                raise _HTTPError(404, "not found")
+            # The slot is taken before the body is read, so a busy server never spools an upload it will reject
+            if not self._holding_slot:
+                self.service.acquire()
+                self._holding_slot = True
+            self._send_json(200, handler())
+        except _HTTPError as exc:
+            # The body may not have been consumed, so the connection cannot be reused
+            self.close_connection = True
+            self._send_json(exc.status, {"error": str(exc)}, exc.headers)
+        except Exception as exc:
+            self.close_connection = True
+            self._send_json(500, {"error": f"{type(exc).__name__}: {exc}"})
+        finally:
+            self._release_slot()
+
+    def _handle_fingerprint(self):
+        remaining = self._content_length()
+        if not remaining:
+            raise _HTTPError(400, "request body must contain audio data")
+
+        # Spool the upload to disk so uncompressed PCM can be memory-mapped like a library file
+        with tempfile.NamedTemporaryFile(prefix="metaaudio-", suffix=".audio") as upload:
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise _HTTPError(400, "request body ended early")
+                upload.write(chunk)
+                remaining -= len(chunk)
+            upload.flush()
+
+            try:
+                signature = self.service.run("cpu", _fingerprint_job, upload.name)
+            except RuntimeError as exc:
+                raise _HTTPError(422, str(exc))
+
+        if signature is None:
+            raise _HTTPError(422, "not enough audio to generate a signature")
+        return signature
+
+    def _handle_recognise(self):
+        from recognition.signature_format import DATA_URI_PREFIX
+
+        uri = self._read_json().get("uri")
+        if not isinstance(uri, str) or not uri.startswith(DATA_URI_PREFIX):
+            raise _HTTPError(400, f"'uri' must be a signature starting with '{DATA_URI_PREFIX}'")
+        try:
+            return self.service.run("io", _recognise_job, uri)
+        except ValueError as exc:
+            raise _HTTPError(400, f"invalid signature: {exc}")
+
+    def _handle_tag(self):
+        raw_path = self._read_json().get("path")
+        if not isinstance(raw_path, str) or not raw_path:
+            raise _HTTPError(400, "'path' is required")
+        filepath = self.service.resolve_library_path(raw_path)
+        return self.service.run("cpu", _tag_job, str(filepath), self.service.options)
+
+
+def main():
+    parser = ArgumentParser(
+        prog="metaaudio-server",
+        description="Serve fingerprinting, recognition and tagging over a local HTTP API"
+    )
+    parser.add_argument("library_dir", help="The directory whose files may be tagged through POST /tag")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument("--workers", type=int, default=2, help="Number of concurrent jobs (default: 2)")
+    parser.add_argument("--queue-size", type=int, default=16, help="Jobs allowed to wait for a worker before requests are rejected with 503 (default: 16)")
+    parser.add_argument("--rename", action="store_true", help="Rename tagged files to '<artist> - <title>.<ext>' format")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files when renaming (requires --rename)")
+    parser.add_argument("--delay", type=float, default=0, help="Minimum seconds between files' recognition requests within each worker process (default: 0)")
+    args = parser.parse_args()
+
+    if args.overwrite and not args.rename:
+        print("--overwrite requires --rename; please specify both or remove --overwrite.", file=sys.stderr)
+        sys.exit(1)
+    if args.workers < 1 or args.queue_size < 0:
+        print("--workers must be at least 1 and --queue-size cannot be negative.", file=sys.stderr)
+        sys.exit(1)
+
+    library_dir = Path(args.library_dir)
+    if not library_dir.is_dir():
+        print(f"Directory not found: {library_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    from metaaudio import RecognitionOptions
+
+    base_dir = library_dir.resolve()
+    options = RecognitionOptions(rename=args.rename, overwrite=args.overwrite, delay=args.delay, base_dir=base_dir)
+    service = RecognitionService(base_dir, options, workers=args.workers, queue_size=args.queue_size)
+    handler = type("RequestHandler", (_RequestHandler,), {"service": service})
+    httpd = ThreadingHTTPServer((args.host, args.port), handler)
+    httpd.daemon_threads = True
+
+    print(f"Serving on http://{args.host}:{httpd.server_port} with {args.workers} workers")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        httpd.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
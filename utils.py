@@ -1,5 +1,7 @@
 from pathlib import Path
 
+SUPPORTED_FORMATS = {'.mp3', '.flac', '.wav', '.aiff'}
+
 
 def _is_within_directory(path: Path, base_dir: Path) -> bool:
     """Return True if path is within base_dir after resolving.
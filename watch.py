@@ -0,0 +1,200 @@
+import os
+import errno
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+from utils import SUPPORTED_FORMATS
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _stat_key(path):
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class _Inotify:
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+
+    def add_tree(self, root):
+        """Watch root and every directory below it, returning the files already present."""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), _WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed between the listing and the watch, so there is nothing left to watch
+                    dirnames.clear()
+                    continue
+                raise OSError(error, f"inotify_add_watch failed for {dirpath}")
+            self._dirs[wd] = Path(dirpath)
+            found.extend(Path(dirpath) / name for name in filenames)
+        return found
+
+    def read(self, timeout):
+        """Return the files touched since the last call, or None if the kernel queue overflowed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        touched = []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # Files can land in a new directory before its watch is in place
+                    touched.extend(self.add_tree(path))
+                continue
+            touched.append(path)
+
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """Yield audio files under root once they have stopped changing for settle_seconds.
+
+    Uses inotify on Linux and falls back to periodically rescanning the tree elsewhere,
+    or when inotify is unavailable or out of watches.
+    """
+
+    def __init__(self, root, settle_seconds=2.0, poll_interval=2.0, use_inotify=True):
+        self.root = Path(root)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self._pending = {}
+        self._known = {}
+        self._inotify = None
+
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify()
+                self._inotify.add_tree(self.root)
+            except (OSError, AttributeError) as exc:
+                print(f"inotify unavailable ({exc}), falling back to polling every {poll_interval:g}s", file=sys.stderr)
+                if self._inotify is not None:
+                    self._inotify.close()
+                self._inotify = None
+
+        # Whatever is already in the tree is handled by the initial pass, not the watcher
+        for path in self._scan():
+            self._known[path] = _stat_key(path)
+
+    def existing_files(self):
+        """Audio files that were in the tree when watching started, for the caller's initial pass."""
+        return sorted(path for path in self._known if path.suffix.lower() in SUPPORTED_FORMATS)
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def mark_seen(self, path):
+        """Record the current state of a file we wrote ourselves so it does not trigger again."""
+        self._pending.pop(path, None)
+        self._known[path] = _stat_key(path)
+
+    def _scan(self):
+        return [
+            Path(dirpath) / name
+            for dirpath, _, filenames in os.walk(self.root)
+            for name in filenames
+        ]
+
+    def _candidates(self, timeout):
+        if self._inotify is not None:
+            try:
+                touched = self._inotify.read(timeout)
+            except OSError as exc:
+                # A new directory could not be watched (e.g. out of watches), so events under it would be missed
+                print(f"inotify failed ({exc}), falling back to polling every {self.poll_interval:g}s", file=sys.stderr)
+                self._inotify.close()
+                self._inotify = None
+                return self._scan()
+            if touched is not None:
+                return touched
+            print("inotify queue overflowed, rescanning library", file=sys.stderr)
+            return self._scan()
+
+        time.sleep(timeout)
+        return self._scan()
+
+    def _ready(self):
+        now = time.monotonic()
+        ready = []
+        for path, (key, since) in list(self._pending.items()):
+            current = _stat_key(path)
+            if current is None:
+                del self._pending[path]
+            elif current != key:
+                self._pending[path] = (current, now)
+            elif now - since >= self.settle_seconds:
+                del self._pending[path]
+                self._known[path] = current
+                ready.append(path)
+        return ready
+
+    def __iter__(self):
+        while True:
+            timeout = min(self.poll_interval, self.settle_seconds) if self._pending else self.poll_interval
+            for path in self._candidates(timeout):
+                if path.suffix.lower() not in SUPPORTED_FORMATS:
+                    continue
+                key = _stat_key(path)
+                if key is None or self._known.get(path) == key:
+                    continue
+                if path not in self._pending or self._pending[path][0] != key:
+                    self._pending[path] = (key, time.monotonic())
+            yield from self._ready()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
@@ -0,0 +1,198 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (state, lease_expires);
+"""
+
+
+@dataclass
+class Lease:
+    path: str
+    owner: str
+    expires: float
+    attempt: int
+
+
+class WorkQueue:
+    """Files to process, shared between hosts through one SQLite database.
+
+    Workers claim a file under a time-limited lease and keep it alive with heartbeats;
+    a lease that expires (host died, process killed) makes the file claimable again
+    until it has been attempted max_attempts times. Paths are stored relative to the
+    library root so hosts may mount the library at different locations.
+
+    The database must live on a filesystem with working POSIX locks. It uses the
+    rollback journal rather than WAL, which does not work over NFS.
+    """
+
+    def __init__(self, db_path, lease_seconds=600.0, max_attempts=3, worker_id=None):
+        self.db_path = str(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front so two hosts cannot claim the same row
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return value
+
+    def enqueue(self, paths: Iterable[str]) -> int:
+        """Add paths that are not queued yet; safe to call from every host."""
+        now = time.time()
+        rows = [(path, now) for path in paths]
+
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO files (path, updated) VALUES (?, ?)", rows)
+            return conn.total_changes - before
+
+        return self._transaction(insert)
+
+    def claim(self) -> Optional[Lease]:
+        def claim_one(conn):
+            now = time.time()
+            # Leases that ran out on their last allowed attempt are not retried again
+            conn.execute(
+                "UPDATE files SET state = ?, error = 'lease expired', owner = NULL, updated = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT path, attempts FROM files "
+                "WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                "ORDER BY attempts, path LIMIT 1",
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+
+            path, attempts = row
+            expires = now + self.lease_seconds
+            conn.execute(
+                "UPDATE files SET state = ?, owner = ?, lease_expires = ?, attempts = ?, updated = ? WHERE path = ?",
+                (LEASED, self.worker_id, expires, attempts + 1, now, path),
+            )
+            return Lease(path=path, owner=self.worker_id, expires=expires, attempt=attempts + 1)
+
+        return self._transaction(claim_one)
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Extend a lease; returns False if it was lost to another worker."""
+        def extend(conn):
+            now = time.time()
+            expires = now + self.lease_seconds
+            cursor = conn.execute(
+                "UPDATE files SET lease_expires = ?, updated = ? WHERE path = ? AND owner = ? AND state = ?",
+                (expires, now, lease.path, lease.owner, LEASED),
+            )
+            if cursor.rowcount:
+                lease.expires = expires
+            return bool(cursor.rowcount)
+
+        return self._transaction(extend)
+
+    def complete(self, lease: Lease, status: str, error: Optional[str] = None, path: Optional[str] = None) -> bool:
+        """Mark a leased file as finished, recording its final path if it was renamed."""
+        def finish(conn):
+            now = time.time()
+            cursor = conn.execute(
+                "UPDATE files SET state = ?, status = ?, error = ?, owner = NULL, lease_expires = NULL, updated = ? "
+                "WHERE path = ? AND owner = ? AND state = ?",
+                (DONE, status, error, now, lease.path, lease.owner, LEASED),
+            )
+            if cursor.rowcount and path and path != lease.path:
+                # Follow the rename so the next scan does not enqueue the file again under its new name
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                conn.execute("UPDATE files SET path = ? WHERE path = ?", (path, lease.path))
+            return bool(cursor.rowcount)
+
+        return self._transaction(finish)
+
+    def release(self, lease: Lease, error: str) -> bool:
+        """Give a file back after a transient failure, or fail it once out of attempts."""
+        def give_back(conn):
+            now = time.time()
+            state = FAILED if lease.attempt >= self.max_attempts else PENDING
+            cursor = conn.execute(
+                "UPDATE files SET state = ?, error = ?, owner = NULL, lease_expires = NULL, updated = ? "
+                "WHERE path = ? AND owner = ? AND state = ?",
+                (state, error, now, lease.path, lease.owner, LEASED),
+            )
+            return bool(cursor.rowcount)
+
+        return self._transaction(give_back)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def next_lease_expiry(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(lease_expires) FROM files WHERE state = ?", (LEASED,)).fetchone()
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Heartbeat:
+    """Keep a lease alive from a background thread while the file is being processed."""
+
+    def __init__(self, queue: WorkQueue, lease: Lease):
+        self.queue = queue
+        self.lease = lease
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = max(1.0, self.queue.lease_seconds / 3)
+        while not self._stop.wait(interval):
+            try:
+                if not self.queue.heartbeat(self.lease):
+                    self.lost = True
+                    return
+            except sqlite3.Error:
+                # A missed beat is survivable as long as one of the next ones gets through
+                continue
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()